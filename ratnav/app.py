@@ -19,37 +19,35 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import signal
+import threading
 import time
-import pygame
 
-import cv2.cv as cv
-import numpy as np
+import cv2
 
-try:
-    import picamera
-    import io
+from ratnav.capture import PICAM, LATEST, CaptureThread, open_camera
+from ratnav.logger import debug, flush as flush_log, log
+from ratnav.metrics import black_percentage, count_set
+from ratnav.morphology import KERNEL
+from ratnav.motionmap import MotionMap
+from ratnav.pipeline import Cascade, ContourProcessor, ThresholdProcessor
+from ratnav.common import clock
+from ratnav.telemetry import MOVING as STATE_MOVING, STANDING as STATE_STANDING, STARTING as STATE_STARTING
+from ratnav.timing import NULL_TIMER, AlertLatency, StageTimer
 
-    PICAM = True
-except ImportError:
-    PICAM = False
+# Optional subsystems (audio, display, recorders) are imported when enabled, to start faster
 
 
+# Stages that run on every frame, their latest timings go into the telemetry
+TELEMETRY_STAGES = ('capture', 'process', 'metric', 'step')
+
 # Audio files
 MOVE = './audio/move.wav'  # A call to drive
 MOVING = './audio/moving.wav'  # When we're really driving again
 STANDING = './audio/standing.wav'  # When we had to stop (this one might annoy)
 
 
-def log(*what):
-    """Simple unfancy logging"""
-
-    msg = ""
-    for item in what:
-        msg += str(item)
-
-    print(msg)
-
-
 class RatNavApp():
     """
     The RatNav Application object
@@ -65,6 +63,9 @@ class RatNavApp():
     changes. If it detects that the camera is standing still (no
     detectable movement happens), it switches into waiting mode
     and observes only the center of your viewport.
+    (With watch=True only that center is processed while waiting,
+    with its own background model, and the whole frame only every
+    watch_interval frames, to notice when the car moves again.)
     If it detects a movement here while waiting, it will alert
     you to this change.
     Once it detects that you're driving again, it will play a
@@ -78,83 +79,215 @@ class RatNavApp():
         self.threshold = val
 
     def capture_frame(self):
+        """Reads the next frame into the sources' buffer, notes its sequence id and capture time"""
 
-        if PICAM:
-            with picamera.PiCamera() as camera:
-                camera.capture('snapshot.jpg')
-                image = cv.LoadImage('snapshot.jpg')
-        else:
-            image = cv.QueryFrame(self.capture)  # Take a frame to init recorder
+        reader = self.capture if self.capture is not None else self.source
 
-        return image
+        frame = reader.read()
+        self.frame_seq = reader.frame_seq
+        self.frame_stamp = reader.frame_stamp
+        self.frame_arrival = reader.frame_arrival  # Latencies start here, the stamp may be media time
 
+        return frame
 
-    def __init__(self, threshold=25, show_windows=True, do_audio=True):
-        """Set up cv buffers, audiofiles and states"""
+    def __init__(self, threshold=25, show_windows=True, do_audio=True, audio=None, source=None, luma=False,
+                 threaded=False, policy=LATEST, slots=3, scale=1, morphology=KERNEL, shape='rect', background='float',
+                 fused=False, watch=False, watch_interval=5, cell=16, inner_threshold=0, coverage='mask', gate=True, gate_threshold=1.0,
+                 display_fps=10, profile=False, record=None, record_frames=None, clips=None, clip_fps=10,
+                 preroll=5.0, postroll=5.0, telemetry=None, snapshot=None, snapshot_interval=60.0,
+                 snapshot_age=600.0):
+        """
+        Set up cv buffers, audiofiles and states.
+
+        The camera opens and delivers its first frame in the background,
+        while audio is set up. The startup phases get logged.
+        """
+
+        startup = StageTimer(window=1)
+        started = t = startup.start()
 
         self.font = None
         self.mode = 'contours'
         self.show = show_windows  # Either or not show the 2 windows
         self.frame = None
+        self.capture = None
+        self.running = False
+        self.timer = StageTimer() if profile else NULL_TIMER  # Per stage hot path timings
+        self.latency = AlertLatency()  # Capture to alert playback
+        self.frame_seq = 0
+        self.frame_stamp = 0.0
+        self.frame_arrival = 0.0
+
+        if source is None:
+            if PICAM:
+                log("Using RPi camera")
+            else:
+                log("Using normal cv camera")
+            source = open_camera(gray=luma)
 
-        if PICAM:
-            log("Using RPi camera")
-            #self.capture = picamera.PiCamera()
-            #self.capture.start_preview()
-            #self.stream = io.BytesIO()
-        else:
-            log("Using normal cv camera")
-            self.capture = cv.CaptureFromCAM(0)
-        log("Camera opened")
-        self.frame = self.capture_frame()  # Take a frame to init buffer sizes
-        log("First frame taken: ", type(self.frame), self.frame)
+        self.source = source
+        self.threaded = threaded
+        self.policy = policy
+        self.slots = slots
 
-        self.gray_frame = cv.CreateImage(cv.GetSize(self.frame), cv.IPL_DEPTH_8U, 1)
-        self.average_frame = cv.CreateImage(cv.GetSize(self.frame), cv.IPL_DEPTH_32F, 3)
-        self.absdiff_frame = None
-        self.previous_frame = None
+        self.opened = None  # Seconds the camera took, or the exception it raised
+        opener = threading.Thread(target=self.start_camera, name="RatNavOpen")
+        opener.start()
 
-        # Will hold the thresholded result
-        self.res = cv.CreateMat(self.frame.height, self.frame.width, cv.CV_8U)
+        self.do_audio = do_audio
 
-        self.frame1gray = cv.CreateMat(self.frame.height, self.frame.width, cv.CV_8U)  # Gray frame at t-1
-        cv.CvtColor(self.frame, self.frame1gray, cv.CV_RGB2GRAY)
+        self.audio = None
+        if do_audio:  # Plays from its own thread, audio is a backend to use instead of pygame
+            from ratnav.audio import AudioEngine, PygameBackend
 
-        self.frame2gray = cv.CreateMat(self.frame.height, self.frame.width, cv.CV_8U)  # Gray frame at t
+            self.audio = AudioEngine(audio if audio is not None else PygameBackend(), (MOVING, MOVE, STANDING))
+            self.audio.start()
+            t = startup.lap('audio', t)
 
-        self.width = self.frame.width
-        self.height = self.frame.height
-        self.nb_pixels = self.width * self.height
+        opener.join()
+        if isinstance(self.opened, Exception):
+            raise self.opened
+        t = startup.lap('camera wait', t)
+        log("Camera opened in %.1f ms, first frame taken:" % (self.opened * 1000.0), self.frame.shape)
+        if threaded:
+            log("Capturing in the background, drop policy:", policy)
 
-        self.inner = (self.width / 4, self.height / 4, (self.width / 2), (self.height / 2))
-        log("Input format: ", self.width, 'x', self.height)
-        log("Scanning for car movement in: ", self.inner)
+        self.height, self.width = self.frame.shape[:2]
+        self.channels = 1 if self.frame.ndim == 2 else 3  # Luma sources deliver single channel frames
+        self.nb_pixels = self.width * self.height
 
-        self.surface = self.width * self.height
+        self.scale = scale
+        self.morphology = morphology
+        self.shape = shape
+        self.background = background
+        self.fused = fused
+        self.cell = max(2, cell // scale)  # Motion map cells are given at frame scale
+        self.gate = gate
+        self.gate_threshold = gate_threshold
+
+        # All processing buffers are allocated here, once
+        self.processor = self.create_processor((self.width, self.height))
+
+        self.inner = (self.width // 4, self.height // 4, (self.width // 2), (self.height // 2))
+        log("Input format: %ix%i" % (self.width, self.height))
+        log("Scanning for car movement in:", self.inner)
+
+        # Watches only the inner rectangle while standing
+        self.watcher = None
+        self.watchmap = None
+        self.watching = False
+        self.watch_interval = max(1, watch_interval)
+        self.watched = 0  # Frames processed in watch mode
+        self.checked = True  # The whole frame was processed for the current frame
+        if watch:
+            self.watcher = self.create_processor(self.inner[2:])
+            self.watchmap = self.create_motionmap(self.watcher.size)
+            log("Watch mode enabled")
+
+        self.snapshots = None
+        if snapshot is not None:  # Warm start from the backgrounds of the last run
+            from ratnav.background import BackgroundSnapshots
+
+            self.snapshots = BackgroundSnapshots(snapshot, snapshot_interval, snapshot_age)
+            restored = self.snapshots.restore(self.processors, self.mode)
+            if restored:
+                log("Backgrounds of %i processor(s) restored from" % restored, snapshot)
+
+        self.processor.process(self.frame)  # Without a snapshot, the first frame is the initial background
+        self.mask = self.processor.mask  # Will hold the thresholded result
+        self.motionmap = self.create_motionmap(self.processor.size)
+        log("Processing at 1/%i scale:" % scale, self.processor.size)
+
+        self.inner_threshold = inner_threshold  # Percentage of motion in a region to count as movement
+
+        self.surface = self.processor.size[0] * self.processor.size[1]  # Contour areas are at processing scale
         self.currentsurface = 0
-        self.currentcontours = None
+        self.currentcoverage = 0.0  # Percentage of the frame in motion, as of the last has_movement()
+        self.currentcontours = None  # Traced on demand, see contours()
+        self.coverage = coverage  # Measure contour mode coverage on the 'mask' or by tracing 'contours'
         self.threshold = threshold
         #self.trigger_time = 0   # Hold timestamp of the last detection
         self.move_time = 0
-        self.alert_time = 0
+        self.alert_time = None  # Of the last alert, media time starts at 0
 
         self.standing = True
         self.moving = False
+        t = startup.lap('processors', t)
 
-        self.do_audio = do_audio
+        self.recorder = None
+        if record is not None:  # Raw frames plus metrics, for replaying and tuning
+            from ratnav.recorder import StreamWriter
+
+            self.recorder = StreamWriter(record, self.frame.shape, record_frames)
+            log("Recording up to %i frames (%.1f MB) to" % (self.recorder.capacity,
+                                                            self.recorder.frames.nbytes / 1048576.0), record)
+
+        self.clips = None
+        if clips is not None:  # JPEG clips around every alert
+            from ratnav.eventclip import EventRecorder
+
+            self.clips = EventRecorder(self.frame.shape, clips, clip_fps, preroll, postroll)
+            log("Keeping %.1f s of pre-roll for event clips in %s, %.1f MB" % (preroll, clips,
+                                                                               self.clips.memory / 1048576.0))
+
+        self.telemetry = None
+        if telemetry is not None:  # Per frame metrics, state and stage timings
+            from ratnav.telemetry import Telemetry
+
+            self.telemetry = Telemetry(telemetry, TELEMETRY_STAGES if profile else ())
+            log("Writing telemetry to", telemetry)
+
+        self.viewer = None
+        if show_windows:  # Renders on this thread, at most display_fps times a second
+            from ratnav.display import Display
+
+            self.viewer = Display(self.frame.shape, display_fps, "Image", self.threshold, self.on_threshold_change)
+            self.viewer.open()
+        startup.lap('extras', t)
 
-        self.sounds = {}
+        log("Ready after %.1f ms (%s)" % ((clock() - started) * 1000.0, ", ".join(
+            "%s %.1f" % (phase, summary['max']) for phase, summary in startup.report().items())))
 
-        if do_audio:
-            pygame.init()
+    def start_camera(self):
+        """Opens the source and takes the first frame, which sets all buffer sizes"""
 
-            self.sounds[MOVING] = pygame.mixer.Sound(MOVING)
-            self.sounds[MOVE] = pygame.mixer.Sound(MOVE)
-            self.sounds[STANDING] = pygame.mixer.Sound(STANDING)
+        try:
+            started = clock()
 
-        if show_windows:
-            cv.NamedWindow("Image")
-            cv.CreateTrackbar("Detection treshold: ", "Image", self.threshold, 100, self.on_threshold_change)
+            self.source.open()  # Stays open until the app is gone
+            if self.threaded:
+                self.capture = CaptureThread(self.source, self.slots, self.policy)
+                self.capture.start()
+
+            self.frame = self.capture_frame()
+            if self.frame is None:
+                raise IOError("The source delivered no frame")
+
+            self.opened = clock() - started
+        except Exception as e:
+            self.opened = e
+
+    def create_processor(self, size):
+        """Sets up the processor of the current mode for frames of the given size"""
+
+        if self.mode == 'contours':
+            processor = ContourProcessor(size, scale=self.scale, morphology=self.morphology, shape=self.shape,
+                                         channels=self.channels, background=self.background, fused=self.fused)
+        else:
+            processor = ThresholdProcessor(size, scale=self.scale, channels=self.channels)
+
+        processor.timer = self.timer
+
+        if self.gate:  # Skip the expensive stages while nothing changes
+            processor = Cascade(processor, self.gate_threshold)
+
+        return processor
+
+    def create_motionmap(self, size):
+        """Sets up a motion map for masks of the given (processing) size"""
+
+        # Threshold mode marks changed pixels black
+        return MotionMap(size, self.cell, inverted=self.mode != 'contours')
 
     def run(self):
         """The actual main loop.
@@ -162,142 +295,303 @@ class RatNavApp():
         * Processes the image
         * Checks for movement
 
+        Without windows, no drawing and no GUI event handling happens at
+        all, the loop is stopped by SIGINT or SIGTERM instead of 'Esc'.
         """
 
+        self.running = True
+        self.install_signal_handlers()
+
         started = time.time()
+        frames = 0
 
-        while True:
+        timer = self.timer
 
+        while self.running:
+
+            t = timer.start()
             currentframe = self.capture_frame()
-            instant = time.time()  # Get timestamp o the frame
+            if currentframe is None:
+                break
+            instant = self.frame_stamp  # Capture time of the frame, media time in replays
+            t = timer.lap('capture', t)
 
-            self.process_image(currentframe)  # Process the image
+            self.step(currentframe, instant)
+            t = timer.lap('step', t)
+            frames += 1
 
-            if self.has_movement():
-                if self.standing:  # we _we're_ standing
-                    log("We detected a first movement.")
-                    self.standing = False
-                    self.move_time = instant
-                if not self.moving and instant > self.move_time + 3:  # once we're sure, alert
-                    log("We are moving.")
-                    self.alert(MOVING)
-                    self.moving = True
+            if self.telemetry is not None:
+                self.telemetry.record(self.frame_seq, instant, self.currentcoverage, self.inner_coverage(),
+                                      self.state, timer)
 
-                    #if instant > started + 10:   # Wait 5 second after the webcam start for luminosity adjusting etc..
-            else:
-                if self.moving:  # seems like we're standing again
-                    log("We stand still.")
-                    self.alert(STANDING)
-                    self.moving = False  # because we didn't see movement for at least a frame
-                self.standing = True
-                if self.has_movement_in_rect(self.currentcontours, self.inner):
-                    log("We should move.")
-                    self.alert(MOVE)
-
-            if self.mode == 'contours':
-                cv.DrawContours(currentframe, self.currentcontours, (0, 0, 255), (0, 255, 0), 1, 2, cv.CV_FILLED)
+            if self.recorder is not None:
+                self.recorder.add(currentframe, self.frame_seq, instant, self.currentcoverage, self.moving)
+                t = timer.lap('record', t)
+
+            if self.clips is not None:
+                self.clips.submit(currentframe, self.frame_seq, instant)
+                t = timer.lap('clips', t)
+
+            # Only a standing camera has a background worth keeping
+            if self.snapshots is not None and self.standing and self.snapshots.due(instant):
+                self.snapshots.save(self.processors, self.mode, instant)
+                timer.lap('snapshot', t)
 
             if self.show:
-                cv.ShowImage("Image", currentframe)
+                self.display(currentframe)
 
-            c = cv.WaitKey(1) % 0x100
-            if c == 27 or c == 10:  # Break if user enters 'Esc'.
-                break
+        duration = time.time() - started
+        log("Processed", frames, "frames in %.2f s (%.2f fps)" % (duration, frames / max(duration, 1e-6)))
 
-    def process_image(self, frame):
-        """Decides which processing to use. No, not exactly a factory."""
+        self.shutdown()
 
-        if self.mode == 'contours':
-            self.process_for_contours(frame)
+    def install_signal_handlers(self):
+        """
+        Lets SIGINT and SIGTERM end the main loop cleanly, SIGUSR1 logs
+        the stage timings
+        """
+
+        def stop(signum, frame):
+            log("Received signal", signum, "- stopping.")
+            self.running = False
+
+        def report(signum, frame):
+            log("Stage timings (ms):\n" + self.timer.format())
+            log("Alert latencies:\n" + self.latency.format())
+
+        try:
+            signal.signal(signal.SIGINT, stop)
+            signal.signal(signal.SIGTERM, stop)
+            if hasattr(signal, 'SIGUSR1'):
+                signal.signal(signal.SIGUSR1, report)
+        except ValueError:  # Not in the main thread, the caller has to stop us
+            pass
+
+    def step(self, currentframe, instant):
+        """Processes one frame and updates the moving/standing state"""
+
+        timer = self.timer
+        t = timer.start()
+
+        self.process_image(currentframe)  # Process the image
+        t = timer.lap('process', t)
+
+        movement = self.has_movement()
+        timer.lap('metric', t)
+
+        if movement:
+            if self.standing:  # we _we're_ standing
+                log("We detected a first movement.")
+                self.standing = False
+                self.move_time = instant
+            if not self.moving and instant > self.move_time + 3:  # once we're sure, alert
+                log("We are moving.")
+                self.alert(MOVING)
+                self.moving = True
+
+                #if instant > started + 10:   # Wait 5 second after the webcam start for luminosity adjusting etc..
         else:
-            self.process_for_threshold(frame)
+            if self.moving:  # seems like we're standing again
+                log("We stand still.")
+                self.alert(STANDING)
+                self.moving = False  # because we didn't see movement for at least a frame
+            if not self.standing and self.watcher is not None:
+                self.watcher.reset()  # Start a fresh background for the center
+            self.standing = True
+            if self.has_inner_movement():
+                log("We should move.")
+                self.alert(MOVE)
+
+    def display(self, currentframe):
+        """Hands the frame and its detection over to the display, when it is due"""
+
+        if self.viewer.quit:  # Break if user enters 'Esc'.
+            self.running = False
+            return
+
+        if not self.viewer.due():
+            return
+
+        contours, offset = (), (0, 0)
+        if self.mode == 'contours':
+            contours = self.active_processor.to_frame(self.contours())
+            offset = self.inner[:2] if self.watching else (0, 0)
 
-    def process_for_contours(self, curframe):
-        """Do cv contour processing."""
+        self.viewer.submit(currentframe, contours, offset, self.inner if self.watching else None)
 
-        cv.Smooth(curframe, curframe)  # Remove false positives
+    def shutdown(self):
+        """Stops capturing and displaying and closes the camera"""
 
-        if not self.absdiff_frame:  # For the first time put values in difference, temp and moving_average
-            self.absdiff_frame = cv.CloneImage(curframe)
-            self.previous_frame = cv.CloneImage(curframe)
-            cv.Convert(curframe, self.average_frame)  # Should convert because after runningavg take 32F pictures
-        else:
-            cv.RunningAvg(curframe, self.average_frame, 0.05)  # Compute the average
+        if self.audio is not None:
+            self.audio.stop()
+            log("Audio:", self.audio.stats())
 
-        cv.Convert(self.average_frame, self.previous_frame)  # Convert back to 8U frame
+        if self.viewer is not None:
+            self.viewer.close()
+            log("Frames displayed:", self.viewer.rendered)
 
-        cv.AbsDiff(curframe, self.previous_frame, self.absdiff_frame)  # moving_average - curframe
+        if self.capture is not None:
+            self.capture.stop()
+            stats = self.capture.stats()
+            log("Frames captured:", stats['captured'], "dropped:", stats['dropped'])
 
-        cv.CvtColor(self.absdiff_frame, self.gray_frame, cv.CV_RGB2GRAY)  # Convert to gray otherwise can't do threshold
-        cv.Threshold(self.gray_frame, self.gray_frame, 50, 255, cv.CV_THRESH_BINARY)
+        if self.recorder is not None:
+            self.recorder.close()
+            stats = self.recorder.stats()
+            log("Frames recorded:", stats['recorded'], "dropped:", stats['dropped'],
+                "beyond capacity:", stats['overflow'])
 
-        cv.Dilate(self.gray_frame, self.gray_frame, None, 15)  # to get object blobs
-        cv.Erode(self.gray_frame, self.gray_frame, None, 10)
+        if self.telemetry is not None:
+            self.telemetry.close()
+            log("Telemetry:", self.telemetry.stats())
 
-    def process_for_threshold(self, frame):
-        """Do cv threshold processing."""
+        if self.clips is not None:
+            self.clips.close()
+            log("Event clips:", self.clips.stats())
 
-        cv.CvtColor(frame, self.frame2gray, cv.CV_RGB2GRAY)
+        if self.gate:
+            log("Stage hit rates:", self.cascade_stats())
 
-        #Absdiff to get the difference between to the frames
-        cv.AbsDiff(self.frame1gray, self.frame2gray, self.res)
+        if self.timer.enabled:
+            log("Stage timings (ms):\n" + self.timer.format())
 
-        #Remove the noise and do the threshold
-        cv.Smooth(self.res, self.res, cv.CV_BLUR, 5, 5)
-        cv.MorphologyEx(self.res, self.res, None, None, cv.CV_MOP_OPEN)
-        cv.MorphologyEx(self.res, self.res, None, None, cv.CV_MOP_CLOSE)
-        cv.Threshold(self.res, self.res, 10, 255, cv.CV_THRESH_BINARY_INV)
+        log("Alert latencies:\n" + self.latency.format())
 
-    def has_movement_in_rect(self, contours, rect):
-        """Checks for movement only in the given rectangle."""
+        if self.snapshots is not None and self.standing:
+            self.snapshots.save(self.processors, self.mode, wait=True)
+            log("Background snapshots written:", self.snapshots.saved)
 
-        result = False
+        self.source.close()
+        flush_log()  # Reports come out before we return
 
-        for contour in contours:
-            if type(contour) == tuple:
-                crect = cv.BoundingRect([contour])
-            else:
-                crect = cv.BoundingRect(contour)
-            cx, cy, cw, ch = crect
-            x, y, w, h = rect
-            if (cx > x) and (cx < x + w):
-                if (cy > y) and (cy < y + h):
-                    result = True
+    def cascade_stats(self):
+        """Share of frames that ran each stage after the change gate, per processor"""
 
-        return result
+        stats = {'frame': self.processor.hit_rates()}
+        if self.watcher is not None:
+            stats['watch'] = self.watcher.hit_rates()
 
-    def has_movement(self):
+        return stats
+
+    def process_image(self, frame):
         """
-        Tests for movement in the image.
-        Currently also tests for movement in the inner rectangle.
+        Runs the frame through the processor of the current mode.
+        While standing in watch mode, only the inner rectangle is processed,
+        the whole frame only every watch_interval frames.
         """
 
-        result = False
-        if self.mode == 'contours':
-            #  Find contours
+        self.watching = self.watcher is not None and self.standing
+        self.currentcontours = None
+
+        if self.watching:
+            x, y, w, h = self.inner
+            self.mask = self.watcher.process(frame[y:y + h, x:x + w])
+
+            t = self.timer.start()
+            self.watchmap.update(self.mask)
+            self.timer.lap('motionmap', t)
+
+            # Checks whether the car moves again and keeps the frame's background current
+            self.watched += 1
+            self.checked = self.watched % self.watch_interval == 0
+            if not self.checked:
+                return
+
+        mask = self.processor.process(frame)
+        if not self.watching:
+            self.mask = mask
+        self.checked = True
+
+        t = self.timer.start()
+        self.motionmap.update(mask)
+        self.timer.lap('motionmap', t)
+
+    def contours(self):
+        """Contours of the current mask, only traced when somebody asks for them"""
+
+        if self.currentcontours is None:
+            self.currentcontours = self.active_processor.contours()
+
+        return self.currentcontours
+
+    @property
+    def processors(self):
+        """The processors in use, the watcher runs while standing"""
+
+        if self.watcher is None:
+            return [self.processor]
+
+        return [self.processor, self.watcher]
+
+    @property
+    def active_processor(self):
+        """The processor that handled the current frame"""
+
+        return self.watcher if self.watching else self.processor
+
+    @property
+    def active_motionmap(self):
+        """The motion map of the current frame"""
 
-            storage = cv.CreateMemStorage(0)
-            contours = cv.FindContours(self.gray_frame, storage, cv.CV_RETR_EXTERNAL, cv.CV_CHAIN_APPROX_SIMPLE)
+        return self.watchmap if self.watching else self.motionmap
 
-            self.currentcontours = contours  # Save contours
+    @property
+    def state(self):
+        """The movement state as a telemetry state"""
 
-            while contours:  # For all contours compute the area
-                self.currentsurface += cv.ContourArea(contours)
-                contours = contours.h_next()
+        if self.moving:
+            return STATE_MOVING
 
-            avg = (self.currentsurface * 100) / self.surface  # Calculate the average of contour area on the total size
+        return STATE_STANDING if self.standing else STATE_STARTING
+
+    def inner_coverage(self):
+        """Percentage of motion in the inner rectangle of the current frame"""
+
+        if self.watching:  # The watched crop is the inner rectangle
+            return self.watchmap.percentage()
+
+        return self.motionmap.percentage(self.processor.to_processing(self.inner))
+
+    def has_inner_movement(self):
+        """Checks for movement in the inner rectangle of the current frame"""
+
+        return self.inner_coverage() > self.inner_threshold
+
+    def has_movement_in_rect(self, rect):
+        """Checks for movement only in the given rectangle (in frame coordinates)."""
+
+        return self.motionmap.percentage(self.processor.to_processing(rect)) > self.inner_threshold
+
+    def has_movement(self):
+        """
+        Tests for movement in the whole frame. While watching, that is
+        only processed every watch_interval frames, in between the last
+        result holds.
+        """
+
+        if not self.checked:
+            return self.currentcoverage > self.threshold
+
+        mask = self.processor.mask
+        result = False
+        if self.mode == 'contours':
+            if self.coverage == 'contours':
+                contours = self.processor.contours() if self.watching else self.contours()
+                for contour in contours:  # For all contours compute the area
+                    self.currentsurface += cv2.contourArea(contour)
+            else:
+                self.currentsurface = count_set(mask)  # The blobs' area, without tracing them
+
+            # Calculate the average of contour area on the total size
+            avg = (self.currentsurface * 100.0) / self.surface
+            self.currentcoverage = avg
             self.currentsurface = 0  # Put back the current surface to 0
 
             if avg > self.threshold:
                 result = True
         else:
-            nb = 0  # Will hold the number of black pixels
-
-            for x in range(self.height):  # Iterate the hole image
-                for y in range(self.width):
-                    if self.res[x, y] == 0.0:  # If the pixel is black keep it
-                        nb += 1
-            avg = (nb * 100.0) / self.nb_pixels  # Calculate the average of black pixel in the image
+            avg = black_percentage(mask)  # Calculate the average of black pixel in the image
+            self.currentcoverage = avg
 
             if avg > self.threshold:  # If over the ceiling trigger the alarm
                 result = True
@@ -307,13 +601,29 @@ class RatNavApp():
     def alert(self, soundname):
         """
         Should play the audio file upon traffic movement alert.
+        Records the latencies from capturing the current frame to
+        deciding to alert and from there to playing the sound.
         """
 
-        if self.alert_time + 5 < time.time():
-            if self.do_audio:
+        t = self.timer.start()
+        decided = clock()
+
+        if self.alert_time is None or self.alert_time + 5 < self.frame_stamp:
+            seq, captured, stamp = self.frame_seq, self.frame_arrival, self.frame_stamp
+
+            if self.audio is not None:
                 log("Playing audio '%s'" % soundname)
-                self.sounds[soundname].play()
 
-            self.alert_time = time.time()
+                def played(playback):  # Called from the audio thread
+                    self.latency.record(seq, soundname, captured, decided, playback, stamp)
+
+                self.audio.play(soundname, played)
+            else:
+                self.latency.record(seq, soundname, captured, decided, stamp=stamp)
+            if self.clips is not None:
+                self.clips.trigger(os.path.splitext(os.path.basename(soundname))[0], self.frame_stamp)
+            self.alert_time = self.frame_stamp
         else:
-            log("Not alerting.")
+            log("Not alerting.", lvl=debug)
+
+        self.timer.lap('alert', t)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Alert audio
+
+AudioEngine plays alerts from its own thread, the analysis loop only
+hands over which sound to play. Only the newest request counts: an
+alert asked for while another one waits replaces it, one asked for
+while another one plays cuts it off.
+
+Backends:
+* PygameBackend - only the pygame mixer, set up with a small buffer,
+  all sounds decoded at start, alerts on one reserved channel
+* NullBackend - plays nothing, for headless runs and benchmarks
+"""
+
+import threading
+
+from ratnav.common import clock
+
+
+class PygameBackend(object):
+    """Plays preloaded sounds on a reserved pygame mixer channel"""
+
+    def __init__(self, frequency=22050, size=-16, channels=1, buffer=256):
+        self.settings = (frequency, size, channels, buffer)
+        self.mixer = None
+        self.channel = None
+        self.sounds = {}
+
+    def open(self):
+        from pygame import mixer  # Only the mixer, no display or input subsystems
+
+        mixer.pre_init(*self.settings)  # A small buffer starts playback sooner
+        mixer.init()
+        mixer.set_reserved(1)  # Nothing but alerts plays on channel 0
+
+        self.mixer = mixer
+        self.channel = mixer.Channel(0)
+
+    def load(self, name):
+        self.sounds[name] = self.mixer.Sound(name)  # Decoded once, stays in memory
+
+    def play(self, name):
+        self.channel.play(self.sounds[name])  # Stops whatever the channel played
+
+    def close(self):
+        if self.mixer is not None:
+            self.mixer.quit()
+            self.mixer = None
+
+
+class NullBackend(object):
+    """Pretends to play, counting what it was asked to"""
+
+    def __init__(self):
+        self.sounds = set()
+        self.played = []
+
+    def open(self):
+        pass
+
+    def load(self, name):
+        self.sounds.add(name)
+
+    def play(self, name):
+        if name not in self.sounds:
+            raise KeyError(name)
+        self.played.append(name)
+
+    def close(self):
+        pass
+
+
+class AudioEngine(threading.Thread):
+    """Plays sounds of a backend off the calling thread"""
+
+    def __init__(self, backend, sounds=()):
+        super(AudioEngine, self).__init__(name="RatNavAudio")
+        self.daemon = True
+
+        self.backend = backend
+        self.backend.open()
+        for name in sounds:
+            self.backend.load(name)
+
+        self.condition = threading.Condition()
+        self.pending = None  # (name, callback) of the newest request
+        self.running = False
+
+        self.requested = 0
+        self.replaced = 0
+
+    def start(self):
+        self.running = True
+        super(AudioEngine, self).start()
+
+    def play(self, name, callback=None):
+        """
+        Requests playing a loaded sound, callback gets the playback start
+        time, from the audio thread
+        """
+
+        with self.condition:
+            if self.pending is not None:
+                self.replaced += 1
+            self.pending = (name, callback)
+            self.requested += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                name, callback = self.pending
+                self.pending = None
+
+            self.backend.play(name)
+            played = clock()
+
+            if callback is not None:
+                callback(played)
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.is_alive():
+            self.join(2.0)
+
+        self.backend.close()
+
+    def stats(self):
+        return {'requested': self.requested,
+                'replaced': self.replaced}
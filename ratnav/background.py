@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Background models and snapshots
+
+The contour processor keeps a running average of the scene, either as
+
+* FloatBackground - a float32 average (cv2.accumulateWeighted), turned
+  into the 8 bit reference by a conversion pass every frame
+* FixedPointBackground - a uint16 8.8 fixed point average, updated with
+  integer shifts, whose high bytes are shifted out into the reference
+
+A fresh background model takes dozens of frames to settle and reports
+motion all over the frame until then. Snapshots keep the models of the
+processors (the 8 bit backgrounds, as a processor's state() gives them)
+in a small .npz file, so a restart can pick up where the last run
+stopped. Each processor's state is stored under its processing size,
+so the full frame and the watched center each get their own back.
+
+A snapshot is only restored for the same mode and processing sizes and
+if it is younger than max_age seconds. It is written to a temporary
+file first and renamed, a crash never leaves a broken snapshot behind.
+
+Usage:
+> snapshots = BackgroundSnapshots('/var/lib/ratnav/background.npz')
+> snapshots.restore([processor, watcher], 'contours')
+> snapshots.save([processor, watcher], 'contours')
+"""
+
+import math
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from ratnav.logger import log, warn
+
+
+class FloatBackground(object):
+    """Running average in float32, 4 bytes per pixel and channel"""
+
+    def __init__(self, shape, alpha=0.05):
+        self.alpha = alpha
+        self.average = np.zeros(shape, np.float32)
+        self.reference = np.zeros(shape, np.uint8)
+
+    def prime(self, image):
+        """Starts the average at the image"""
+
+        self.average[:] = image
+        self.reference[:] = image
+
+    def update(self, image):
+        cv2.accumulateWeighted(image, self.average, self.alpha)
+        cv2.convertScaleAbs(self.average, dst=self.reference)  # Back to 8U
+
+
+class FixedPointBackground(object):
+    """
+    Running average in 8.8 fixed point, 2 bytes per pixel and channel.
+
+    The weight of a new image is 2 ** -shift, the power of two nearest to
+    alpha (0.0625 for 0.05). Per update:
+    > average -= average >> shift
+    > average += image << (8 - shift)
+    which settles at image << 8 exactly, without overflowing 16 bits.
+    The reference holds the high bytes of the average. It is a contiguous
+    copy, the diff against a strided view of them would make cv2 copy it
+    into a temporary image every frame.
+    """
+
+    def __init__(self, shape, alpha=0.05):
+        self.shift = min(8, max(1, int(round(-math.log(alpha, 2)))))
+        self.alpha = 2.0 ** -self.shift
+
+        self.average = np.zeros(shape, np.uint16)
+        self.scratch = np.zeros(shape, np.uint16)
+        self.reference = np.zeros(shape, np.uint8)
+
+    def prime(self, image):
+        np.left_shift(image, 8, out=self.average, dtype=np.uint16)
+        self.reference[:] = image
+
+    def update(self, image):
+        np.right_shift(self.average, self.shift, out=self.scratch)
+        np.subtract(self.average, self.scratch, out=self.average)
+        np.left_shift(image, 8 - self.shift, out=self.scratch, dtype=np.uint16)
+        np.add(self.average, self.scratch, out=self.average)
+        np.right_shift(self.average, 8, out=self.reference, casting='unsafe')  # Cast in small chunks
+
+
+MODELS = {'float': FloatBackground,
+          'fixed': FixedPointBackground}
+
+
+def save_snapshot(path, state, mode):
+    """Writes a processor state atomically"""
+
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        np.savez_compressed(f, mode=np.array(mode), saved=np.array(time.time()), **state)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(temporary, path)
+
+
+def load_snapshot(path, mode, max_age=None):
+    """Returns the stored processor state, or None if there is no usable one"""
+
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as snapshot:
+        if str(snapshot['mode']) != mode:
+            return None
+
+        age = time.time() - float(snapshot['saved'])
+        if max_age is not None and not 0 <= age <= max_age:
+            return None
+
+        return dict((name, snapshot[name]) for name in snapshot.files if name not in ('mode', 'saved'))
+
+
+def _suffix(processor):
+    """Distinguishes the states of processors by their processing size"""
+
+    return '_%ix%i' % tuple(processor.size)
+
+
+class BackgroundSnapshots(object):
+    """Periodic, non blocking snapshots of the backgrounds of some processors"""
+
+    def __init__(self, path, interval=60.0, max_age=600.0):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self.last = None
+        self.writer = None
+
+        self.saved = 0
+
+    def restore(self, processors, mode):
+        """Primes the processors with the snapshot, returns how many had a usable state"""
+
+        try:
+            state = load_snapshot(self.path, mode, self.max_age)
+        except (IOError, OSError, ValueError, KeyError) as e:  # Unreadable, start fresh
+            log("Can't read background snapshot", self.path, e, lvl=warn)
+            return 0
+
+        if state is None:
+            return 0
+
+        restored = 0
+        for processor in processors:
+            suffix = _suffix(processor)
+            own = dict((name[:-len(suffix)], array) for name, array in state.items() if name.endswith(suffix))
+            if own and processor.restore(own):
+                restored += 1
+
+        return restored
+
+    def due(self, now):
+        if self.last is None:
+            self.last = now
+
+        return now - self.last >= self.interval and not self.busy()
+
+    def busy(self):
+        return self.writer is not None and self.writer.is_alive()
+
+    def save(self, processors, mode, now=None, wait=False):
+        """
+        Snapshots the processors' states, writing them in the background
+        unless wait is set. Skipped, while an earlier snapshot is still
+        written.
+        """
+
+        if self.busy():
+            if not wait:
+                return False
+            self.writer.join()
+
+        state = {}
+        for processor in processors:
+            suffix = _suffix(processor)
+            state.update((name + suffix, array.copy()) for name, array in processor.state().items())
+        if now is not None:
+            self.last = now
+
+        self.writer = threading.Thread(target=self.write, args=(state, mode), name="RatNavSnapshot")
+        self.writer.daemon = True
+        self.writer.start()
+
+        if wait:
+            self.writer.join()
+
+        return True
+
+    def write(self, state, mode):
+        try:
+            save_snapshot(self.path, state, mode)
+            self.saved += 1
+        except (IOError, OSError) as e:  # The next snapshot might succeed
+            log("Can't write background snapshot", self.path, e, lvl=warn)
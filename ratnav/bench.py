@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+RatNav benchmarks
+
+Run e.g. like this:
+> python -m ratnav.bench morphology --width 640 --height 480
+> python -m ratnav.bench replay drive.avi --scale 2
+> python -m ratnav.bench background drive.npy --luma
+
+replay runs a recorded drive (or the synthetic source) through the real
+detection pipeline as fast as possible, without camera, audio or window,
+and reports throughput, per frame latency and the alert timeline. Alert
+times are media times of the source, so runs are comparable.
+
+background runs the float and the fixed point background models side by
+side over a source and reports how far their references and masks drift
+apart, next to what each costs.
+"""
+
+import argparse
+import os
+import time
+from array import array
+
+import cv2
+import numpy as np
+
+from ratnav.audio import NullBackend
+from ratnav.common import clock
+from ratnav.morphology import KERNEL, METHODS, SHAPES, Morphology
+from ratnav.timing import AlertLatency, StageTimer
+
+
+def motion_mask(size, blobs=40, seed=23):
+    """A reproducible mask with scattered motion blobs and speckles"""
+
+    width, height = size
+    rng = np.random.RandomState(seed)
+    mask = np.zeros((height, width), np.uint8)
+
+    for _ in range(blobs):
+        x, y = rng.randint(0, width), rng.randint(0, height)
+        w, h = rng.randint(2, width // 10), rng.randint(2, height // 10)
+        cv2.rectangle(mask, (x, y), (x + w, y + h), 255, -1)
+
+    mask[rng.randint(0, height, blobs * 20), rng.randint(0, width, blobs * 20)] = 255
+
+    return mask
+
+
+def timed(func, repeat):
+    """Milliseconds per call of func, averaged over repeat calls"""
+
+    func()  # Warm up
+
+    start = time.time()
+    for _ in range(repeat):
+        func()
+
+    return (time.time() - start) * 1000.0 / repeat
+
+
+def bench_morphology(size=(640, 480), dilate=15, erode=10, shape='rect', repeat=50):
+    """Compares all morphology methods against the iterated 3x3 version"""
+
+    source = motion_mask(size)
+    mask = np.zeros_like(source)
+
+    reference = Morphology(size, dilate, erode, 'iterated')
+    mask[:] = source
+    expected = reference.apply(mask).copy()
+
+    print("Morphology on %ix%i, dilate %i, erode %i, %s element" % (size[0], size[1], dilate, erode, shape))
+    print("%-10s %7s %10s %14s" % ('method', 'passes', 'ms/frame', 'differs (px)'))
+
+    for method in METHODS:
+        if method == 'box' and shape != 'rect':
+            continue
+
+        morphology = Morphology(size, dilate, erode, method, shape if method != 'iterated' else 'rect')
+
+        def run():
+            mask[:] = source
+            morphology.apply(mask)
+
+        latency = timed(run, repeat)
+        differs = cv2.countNonZero(cv2.absdiff(mask, expected))
+
+        print("%-10s %7i %10.3f %14i" % (method, morphology.passes, latency, differs))
+
+
+def percentile(samples, p):
+    """The p percentile of sorted samples"""
+
+    return samples[int(round(p * (len(samples) - 1)))]
+
+
+def bench_replay(spec, limit=None, luma=False, **options):
+    """
+    Replays the source through RatNavApp, options go to RatNavApp.
+    With luma the source delivers single channel frames.
+    Returns the alert timeline as (media time, sequence id, sound) tuples.
+    """
+
+    from ratnav.app import RatNavApp
+    from ratnav.capture import open_source
+
+    options.setdefault('do_audio', False)
+    app = RatNavApp(show_windows=False, source=open_source(spec, luma), **options)
+    app.latency = AlertLatency(keep=None)  # Keep the whole timeline
+
+    latencies = array('d')
+
+    started = clock()
+    while limit is None or len(latencies) < limit:
+        t = clock()
+
+        frame = app.capture_frame()
+        if frame is None:
+            break
+        app.step(frame, app.frame_stamp)
+
+        latencies.append(clock() - t)
+
+    duration = clock() - started
+    app.shutdown()
+
+    frames = len(latencies)
+    samples = sorted(latencies)
+    timeline = [(stamp, seq, os.path.basename(sound)) for seq, sound, stamp, c2d, d2p in app.latency.alerts]
+
+    print("Replayed %i frames of %s in %.2f s: %.1f fps" % (frames, spec, duration, frames / max(duration, 1e-9)))
+    if samples:
+        print("Per frame latency (ms): mean %.3f p50 %.3f p95 %.3f p99 %.3f max %.3f" % (
+            sum(samples) * 1000.0 / frames, percentile(samples, 0.5) * 1000.0, percentile(samples, 0.95) * 1000.0,
+            percentile(samples, 0.99) * 1000.0, samples[-1] * 1000.0))
+
+    print("Alerts:")
+    for stamp, seq, sound in timeline:
+        print("%10.2f s  frame %6i  %s" % (stamp, seq, sound))
+
+    return timeline
+
+
+def bench_background(spec, limit=None, luma=False, scale=1, alpha=0.05):
+    """Compares the fixed point background model with the float one on the frames of a source"""
+
+    from ratnav.capture import open_source
+    from ratnav.pipeline import ContourProcessor
+
+    source = open_source(spec, luma)
+    source.open()
+    frame = source.read()
+    channels = 1 if frame.ndim == 2 else 3
+
+    def processor(model, alpha):
+        result = ContourProcessor(source.size, alpha=alpha, scale=scale, channels=channels, background=model)
+        result.timer = StageTimer()
+        return result
+
+    fixed = processor('fixed', alpha)
+    # The same weight as the fixed point model (a power of two) and the configured one
+    models = [('fixed', fixed), ('float', processor('float', fixed.background.alpha)),
+              ('float', processor('float', alpha))]
+
+    height, width = fixed.mask.shape
+    pixels = float(width * height)
+    difference = np.zeros_like(fixed.mask)
+    errors = [[0.0, 0, 0.0] for _ in models]  # Mean and max reference error, mask pixels differing
+
+    frames = 0
+    while frame is not None and (limit is None or frames < limit):
+        for _, model in models:
+            model.process(frame)
+
+        for error, (_, model) in zip(errors, models):
+            error[0] += cv2.norm(model.reference, fixed.reference, cv2.NORM_L1) / model.reference.size
+            error[1] = max(error[1], cv2.norm(model.reference, fixed.reference, cv2.NORM_INF))
+            cv2.absdiff(model.mask, fixed.mask, dst=difference)
+            error[2] += cv2.countNonZero(difference) / pixels
+
+        frames += 1
+        frame = source.read()
+
+    source.close()
+
+    print("Background models on %i frames of %s, %ix%i, %i channel(s)" % (frames, spec, width, height, channels))
+    print("%-6s %8s %8s %9s %13s %13s %14s" % ('model', 'alpha', 'B/px', 'ms/frame', 'ref err mean', 'ref err max',
+                                               'mask differs %'))
+    for error, (name, model) in zip(errors, models):
+        state = (model.background.average.itemsize + model.background.reference.itemsize) * channels
+        report = model.timer.report()
+        background = report['background']['mean'] + report['diff']['mean']  # The diff reads the reference
+        print("%-6s %8.4f %8i %9.3f %13.3f %13i %14.4f" % (name, model.background.alpha, state, background,
+                                                           error[0] / max(frames, 1), error[1],
+                                                           error[2] * 100.0 / max(frames, 1)))
+
+
+def bench_fused(spec, limit=None, luma=False, scale=1):
+    """Compares the fused motion kernel with the OpenCV passes on the frames of a source"""
+
+    from ratnav.capture import open_source
+    from ratnav.fused import NUMBA, traffic
+    from ratnav.pipeline import ContourProcessor
+
+    source = open_source(spec, luma)
+    source.open()
+    frame = source.read()
+    channels = 1 if frame.ndim == 2 else 3
+
+    if not NUMBA:
+        print("numba is not installed, the fused processors run the OpenCV passes")
+
+    def processor(model, fused):
+        result = ContourProcessor(source.size, scale=scale, channels=channels, background=model, fused=fused)
+        result.timer = StageTimer()
+        return result
+
+    pairs = [(model, processor(model, False), processor(model, True)) for model in ('float', 'fixed')]
+
+    height, width = pairs[0][1].mask.shape
+    difference = np.zeros_like(pairs[0][1].mask)
+    differing = [0 for _ in pairs]  # Mask pixels differing, over all frames
+
+    frames = 0
+    while frame is not None and (limit is None or frames < limit):
+        for i, (_, passes, fused) in enumerate(pairs):
+            passes.process(frame)
+            fused.process(frame)
+            cv2.absdiff(passes.mask, fused.mask, dst=difference)
+            differing[i] += cv2.countNonZero(difference)
+
+        frames += 1
+        frame = source.read()
+
+    source.close()
+
+    def motion(processor):
+        """Mean ms per frame from the background update to the mask"""
+        report = processor.timer.report()
+        total = sum(report[stage]['mean'] * report[stage]['count'] for stage in ('background', 'diff', 'threshold', 'fused')
+                    if report.get(stage) is not None)
+        return total / max(frames, 1)
+
+    print("Motion kernel on %i frames of %s, %ix%i, %i channel(s)" % (frames, spec, width, height, channels))
+    print("%-6s %-7s %8s %9s %16s" % ('model', 'kernel', 'B/px', 'ms/frame', 'mask differs px'))
+    for count, (name, passes, fused) in zip(differing, pairs):
+        print("%-6s %-7s %8i %9.3f %16s" % (name, 'opencv', traffic(channels, name), motion(passes), '-'))
+        print("%-6s %-7s %8i %9.3f %16i" % (name, 'fused' if fused.fused is not None else 'opencv',
+                                            traffic(channels, name, fused.fused is not None), motion(fused), count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RatNav benchmarks')
+    parser.add_argument('benchmark', choices=['morphology', 'replay', 'background', 'fused'])
+    parser.add_argument('source', nargs='?', default='synthetic',
+                        help='Replay source: a video file, an image directory or synthetic')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--dilate', type=int, default=15)
+    parser.add_argument('--erode', type=int, default=10)
+    parser.add_argument('--shape', choices=sorted(SHAPES), default='rect')
+    parser.add_argument('--limit', type=int, help='Replay at most this many frames')
+    parser.add_argument('--scale', type=int, choices=[1, 2, 4, 8], default=1)
+    parser.add_argument('--morphology', choices=METHODS, default=KERNEL)
+    parser.add_argument('--watch', action='store_true')
+    parser.add_argument('--no-gate', action='store_true')
+    parser.add_argument('--profile', action='store_true', help='Also report stage timings')
+    parser.add_argument('--luma', action='store_true', help='Replay luma only frames')
+    parser.add_argument('--background', choices=['float', 'fixed'], default='float')
+    parser.add_argument('--fused', action='store_true', help='Use the fused motion kernel, if numba is installed')
+    parser.add_argument('--null-audio', action='store_true', help='Hand alerts to the audio engine, playing nothing')
+    args = parser.parse_args()
+
+    if args.benchmark == 'morphology':
+        bench_morphology((args.width, args.height), args.dilate, args.erode, args.shape, args.repeat)
+    elif args.benchmark == 'background':
+        bench_background(args.source, args.limit, args.luma, args.scale)
+    elif args.benchmark == 'fused':
+        bench_fused(args.source, args.limit, args.luma, args.scale)
+    elif args.benchmark == 'replay':
+        audio = NullBackend() if args.null_audio else None
+        bench_replay(args.source, args.limit, args.luma, scale=args.scale, morphology=args.morphology, shape=args.shape,
+                     background=args.background, fused=args.fused, watch=args.watch, gate=not args.no_gate, profile=args.profile,
+                     do_audio=audio is not None, audio=audio)
+
+
+if __name__ == "__main__":
+    main()
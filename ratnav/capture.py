@@ -0,0 +1,709 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Frame sources
+
+Long lived capture sources, that keep their device open and deliver
+frames into one preallocated BGR buffer, or with gray=True into a single
+channel luma buffer (the Pi camera then records YUV and hands over just
+the Y plane, others convert once on capture):
+
+* CVCamera - any camera cv2.VideoCapture can open
+* PiCameraSource - the Raspberry Pi camera, streaming raw frames
+* FakeCamera - a synthetic stand-in for testing without hardware
+* VideoFileSource, ImageDirectorySource - recorded drives for replay
+
+open_source() picks one of them from a short description.
+
+Usage:
+> source = open_camera()
+> source.open()
+> frame = source.read()  # Always the same array, overwritten per frame
+> source.frame_seq, source.frame_stamp  # Sequence id and capture time
+> source.close()
+
+Capture times are monotonic common.clock() seconds. Recorded and
+synthetic sources with a frame rate report media time instead, so a
+replay sees the same timing, however fast it runs. Their frame_arrival
+is the clock() time a frame was delivered, what latencies are measured
+from. For live sources it is the capture time.
+
+A CaptureThread decouples capturing from analysis by filling a FrameRing
+of preallocated buffers in the background.
+"""
+
+import os
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+
+from ratnav.common import clock, image_extensions
+
+
+
+def _available(name):
+    """Whether a module can be imported, without importing it"""
+
+    try:
+        from importlib.util import find_spec
+    except ImportError:  # Python 2
+        import imp
+
+        try:
+            imp.find_module(name)
+        except ImportError:
+            return False
+        return True
+
+    return find_spec(name) is not None
+
+
+PICAM = _available('picamera')  # Imported only when a PiCameraSource opens
+
+
+def _capture_prop(name):
+    """Looks up a VideoCapture property constant in old and new cv2 layouts"""
+
+    if hasattr(cv2, 'CAP_PROP_' + name):
+        return getattr(cv2, 'CAP_PROP_' + name)
+    return getattr(cv2.cv, 'CV_CAP_PROP_' + name)
+
+
+class FrameSource(object):
+    """
+    Base class for frame sources.
+
+    Subclasses implement open(), close() and grab(out), which has to fill
+    the given array with the next frame and return False, if no frame
+    could be delivered.
+    """
+
+    live = True  # Stamps frames with the capture time, not media time
+
+    def __init__(self, width=640, height=480, gray=False):
+        self.width = width
+        self.height = height
+        self.gray = gray
+        self.buffer = None
+        self.frame_seq = 0
+        self.frame_stamp = 0.0
+        self.frame_arrival = 0.0
+
+    @property
+    def size(self):
+        return self.width, self.height
+
+    @property
+    def shape(self):
+        if self.gray:
+            return self.height, self.width
+
+        return self.height, self.width, 3
+
+    def allocate(self):
+        """Allocates the frame buffer, once the final frame size is known"""
+
+        self.buffer = np.zeros(self.shape, np.uint8)
+
+    def open(self):
+        self.allocate()
+
+    def close(self):
+        pass
+
+    def grab(self, out):
+        raise NotImplementedError
+
+    def timestamp(self):
+        """Capture time of the frame grab() delivered last"""
+
+        return clock()
+
+    def stamps(self):
+        """Time stamp and monotonic arrival time of the frame grab() delivered last"""
+
+        stamp = self.timestamp()
+
+        return stamp, stamp if self.live else clock()
+
+    def read(self, out=None):
+        """Returns the next frame (in out or the sources' buffer) or None"""
+
+        if out is None:
+            out = self.buffer
+
+        if not self.grab(out):
+            return None
+
+        self.frame_seq += 1
+        self.frame_stamp, self.frame_arrival = self.stamps()
+
+        return out
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CVCamera(FrameSource):
+    """Any camera that cv2.VideoCapture can open"""
+
+    def __init__(self, device=0, width=None, height=None, gray=False):
+        super(CVCamera, self).__init__(width, height, gray)
+        self.device = device
+        self.capture = None
+        self.color = None  # What the driver delivers, before the luma conversion
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.device)
+
+        if self.width and self.height:
+            self.capture.set(_capture_prop('FRAME_WIDTH'), self.width)
+            self.capture.set(_capture_prop('FRAME_HEIGHT'), self.height)
+
+        ok, frame = self.capture.read()  # The driver decides about the final size
+        if not ok:
+            raise IOError("Can't read from camera %s" % self.device)
+
+        self.height, self.width = frame.shape[:2]
+        self.allocate()
+        if self.gray:
+            self.color = frame
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.buffer)
+        else:
+            np.copyto(self.buffer, frame)
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def grab(self, out):
+        target = self.color if self.gray else out
+
+        ok, frame = self.capture.read(target)
+        if not ok:
+            return False
+
+        if frame is not target:  # Some bindings ignore the destination
+            np.copyto(target, frame)
+
+        if self.gray:
+            cv2.cvtColor(self.color, cv2.COLOR_BGR2GRAY, dst=out)
+
+        return True
+
+
+class _PiCameraOutput(object):
+    """File-like target for picamera that hands whole raw frames over"""
+
+    def __init__(self, source):
+        self.source = source
+
+    def write(self, data):
+        self.source.receive(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class PiCameraSource(FrameSource):
+    """
+    Raspberry Pi camera source.
+
+    The camera is opened once and records unencoded BGR video into a
+    custom output, or YUV420 with gray=True, of which only the leading Y
+    plane is used. Incoming frames are written into the back half of a
+    preallocated double buffer, which is swapped with the front half
+    when a frame is complete. No files and no image codecs are involved.
+    """
+
+    def __init__(self, width=640, height=480, framerate=30, gray=False):
+        super(PiCameraSource, self).__init__(width, height, gray)
+        self.framerate = framerate
+        self.camera = None
+
+        # The firmware pads raw frames to 32 columns and 16 rows
+        self.padded_width = (width + 31) // 32 * 32
+        self.padded_height = (height + 15) // 16 * 16
+        if gray:  # Full size Y plane, then quarter size U and V planes
+            self.padded_shape = (self.padded_height * 3 // 2, self.padded_width)
+        else:
+            self.padded_shape = (self.padded_height, self.padded_width, 3)
+        self.frame_bytes = int(np.prod(self.padded_shape))
+
+        self.front = None
+        self.back = None
+        self.offset = 0
+        self.front_stamp = 0.0
+        self.delivered_stamp = 0.0
+        self.sequence = 0
+        self.delivered = 0
+        self.condition = threading.Condition()
+
+    def open(self):
+        self.allocate()
+
+        self.front = np.zeros(self.padded_shape, np.uint8)
+        self.back = np.zeros(self.padded_shape, np.uint8)
+        self.offset = 0
+
+        import picamera
+
+        self.camera = picamera.PiCamera()
+        self.camera.resolution = (self.width, self.height)
+        self.camera.framerate = self.framerate
+        self.camera.start_recording(_PiCameraOutput(self), format='yuv' if self.gray else 'bgr')
+
+    def close(self):
+        if self.camera is not None:
+            self.camera.stop_recording()
+            self.camera.close()
+            self.camera = None
+
+    def receive(self, data):
+        """Called from picamera's encoder thread with (parts of) raw frames"""
+
+        flat = self.back.reshape(-1)
+        chunk = np.frombuffer(data, np.uint8)[:self.frame_bytes - self.offset]
+        flat[self.offset:self.offset + len(chunk)] = chunk
+        self.offset += len(chunk)
+
+        if self.offset < self.frame_bytes:
+            return
+
+        self.offset = 0
+        with self.condition:
+            self.front, self.back = self.back, self.front
+            self.front_stamp = clock()  # Stamped on arrival, not when somebody reads it
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def grab(self, out):
+        with self.condition:
+            while self.sequence == self.delivered:
+                self.condition.wait(1.0)
+                if self.camera is None:
+                    return False
+            self.delivered = self.sequence
+            self.delivered_stamp = self.front_stamp
+            np.copyto(out, self.front[:self.height, :self.width])
+
+        return True
+
+    def timestamp(self):
+        return self.delivered_stamp
+
+
+class FakeCamera(FrameSource):
+    """
+    Synthetic camera stand-in.
+
+    Either cycles through the given frames, or renders a box gliding over
+    a static gradient. A speed of 0 gives a perfectly static scene, phases
+    is a list of (frames, speed) tuples that is repeated, e.g. to let the
+    box stand and go. With a length the stream ends after that many frames,
+    with fps the frames carry media time instead of the capture time.
+    Given frames have to match gray.
+    """
+
+    def __init__(self, width=640, height=480, frames=None, speed=8, box=(80, 60), length=None, fps=None,
+                 phases=None, gray=False):
+        super(FakeCamera, self).__init__(width, height, gray)
+        self.frames = frames
+        self.speed = speed
+        self.box = box
+        self.length = length
+        self.fps = fps
+        self.live = not fps
+        self.phases = phases
+        self.index = 0
+        self.position = 0
+        self.background = None
+
+        if frames:
+            self.height, self.width = frames[0].shape[:2]
+
+    def open(self):
+        self.allocate()
+        self.index = 0
+        self.position = 0
+
+        if not self.frames:
+            gradient = np.linspace(40, 200, self.width).astype(np.uint8)
+            self.background = np.empty(self.shape, np.uint8)
+            self.background[:] = gradient[np.newaxis, :] if self.gray else gradient[np.newaxis, :, np.newaxis]
+
+    def current_speed(self):
+        if not self.phases:
+            return self.speed
+
+        index = self.index % sum(count for count, speed in self.phases)
+        for count, speed in self.phases:
+            if index < count:
+                return speed
+            index -= count
+
+    def grab(self, out):
+        if self.length is not None and self.index >= self.length:
+            return False
+
+        if self.frames:
+            np.copyto(out, self.frames[self.index % len(self.frames)])
+        else:
+            np.copyto(out, self.background)
+
+            bw, bh = self.box
+            self.position += self.current_speed()
+            x = self.position % max(1, self.width - bw)
+            y = (self.height - bh) // 2
+            cv2.rectangle(out, (x, y), (x + bw, y + bh), 80 if self.gray else (20, 20, 220), -1)
+
+        self.index += 1
+
+        return True
+
+    def timestamp(self):
+        if self.fps:
+            return (self.index - 1) / float(self.fps)
+
+        return clock()
+
+
+class VideoFileSource(FrameSource):
+    """Replays a video file, frames carry their time in the video"""
+
+    live = False
+
+    def __init__(self, path, fps=None, gray=False):
+        super(VideoFileSource, self).__init__(None, None, gray)
+        self.path = path
+        self.fps = fps
+        self.capture = None
+        self.pending = None
+        self.color = None
+        self.index = 0
+
+    def open(self):
+        self.capture = cv2.VideoCapture(self.path)
+        if not self.capture.isOpened():
+            raise IOError("Can't open video file %s" % self.path)
+
+        if not self.fps:
+            self.fps = self.capture.get(_capture_prop('FPS')) or 25.0
+
+        ok, frame = self.capture.read()
+        if not ok:
+            raise IOError("Video file %s holds no frames" % self.path)
+
+        self.height, self.width = frame.shape[:2]
+        self.allocate()
+        self.color = frame
+        self.pending = frame  # Delivered by the first grab
+        self.index = 0
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+    def grab(self, out):
+        target = self.color if self.gray else out
+
+        if self.pending is not None:
+            if self.pending is not target:
+                np.copyto(target, self.pending)
+            self.pending = None
+        else:
+            ok, frame = self.capture.read(target)
+            if not ok:
+                return False
+            if frame is not target:
+                np.copyto(target, frame)
+
+        if self.gray:
+            cv2.cvtColor(self.color, cv2.COLOR_BGR2GRAY, dst=out)
+
+        self.index += 1
+
+        return True
+
+    def timestamp(self):
+        return (self.index - 1) / float(self.fps)
+
+
+class ImageDirectorySource(FrameSource):
+    """Replays the images of a directory in name order at the given frame rate"""
+
+    live = False
+
+    def __init__(self, path, fps=10.0, gray=False):
+        super(ImageDirectorySource, self).__init__(None, None, gray)
+        self.flags = cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR
+        self.path = path
+        self.fps = fps
+        self.files = []
+        self.index = 0
+
+    def open(self):
+        self.files = sorted(os.path.join(self.path, name) for name in os.listdir(self.path)
+                            if os.path.splitext(name)[1].lower() in image_extensions)
+        if not self.files:
+            raise IOError("No images in %s" % self.path)
+
+        first = cv2.imread(self.files[0], self.flags)
+        self.height, self.width = first.shape[:2]
+        self.allocate()
+        self.index = 0
+
+    def grab(self, out):
+        if self.index >= len(self.files):
+            return False
+
+        image = cv2.imread(self.files[self.index], self.flags)  # Decodes just the luma if gray
+        if image is None:
+            raise IOError("Can't read image %s" % self.files[self.index])
+        if image.shape != out.shape:
+            cv2.resize(image, (self.width, self.height), dst=out)
+        else:
+            np.copyto(out, image)
+
+        self.index += 1
+
+        return True
+
+    def timestamp(self):
+        return (self.index - 1) / float(self.fps)
+
+
+LATEST = 'latest'  # Only the newest frame is kept, all older ones are dropped
+DROP_OLDEST = 'drop-oldest'  # Frames queue up, the oldest is dropped when full
+
+POLICIES = (LATEST, DROP_OLDEST)
+
+
+class FrameRing(object):
+    """
+    A fixed number of preallocated frame buffers shared between one
+    writer and one reader.
+
+    The writer acquires a slot, fills it and publishes it. The reader
+    gets a published slot, which stays untouched until its next get().
+    Under the 'latest' policy publishing a frame drops every older,
+    unread one, under 'drop-oldest' the writer reuses the oldest unread
+    slot once no free slot is left.
+    """
+
+    def __init__(self, shape, slots=3, policy=LATEST):
+        if policy not in POLICIES:
+            raise ValueError("Unknown drop policy: %s" % policy)
+        if slots < 2:
+            raise ValueError("A frame ring needs at least two slots")
+
+        self.policy = policy
+        self.buffers = [np.zeros(shape, np.uint8) for _ in range(slots)]
+        self.seqs = [0] * slots
+        self.stamps = [0.0] * slots
+        self.arrivals = [0.0] * slots
+
+        self.free = deque(range(slots))
+        self.ready = deque()
+        self.held = None
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.captured = 0
+        self.dropped = 0
+        self.delivered = 0
+
+    def acquire(self):
+        """Returns the index of a slot the writer may fill"""
+
+        with self.condition:
+            if self.free:
+                return self.free.popleft()
+
+            self.dropped += 1  # Overwrite the oldest unread frame
+            return self.ready.popleft()
+
+    def release(self, slot):
+        """Gives back an acquired slot without publishing it"""
+
+        with self.condition:
+            self.free.append(slot)
+
+    def publish(self, slot, seq, stamp, arrival=None):
+        """Makes a filled slot available to the reader"""
+
+        with self.condition:
+            self.seqs[slot] = seq
+            self.stamps[slot] = stamp
+            self.arrivals[slot] = stamp if arrival is None else arrival
+            self.captured += 1
+
+            if self.policy == LATEST:
+                self.dropped += len(self.ready)
+                self.free.extend(self.ready)
+                self.ready.clear()
+
+            self.ready.append(slot)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Returns the slot index of the next frame to analyse or None, if the
+        ring was closed (or the timeout expired)
+        """
+
+        with self.condition:
+            if self.held is not None:
+                self.free.append(self.held)
+                self.held = None
+
+            while not self.ready:
+                if self.closed:
+                    return None
+                self.condition.wait(timeout)
+                if timeout is not None and not self.ready:
+                    return None
+
+            self.held = self.ready.popleft()
+            self.delivered += 1
+
+            return self.held
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        """Counts of captured, dropped and delivered frames"""
+
+        with self.condition:
+            return {'captured': self.captured,
+                    'dropped': self.dropped,
+                    'delivered': self.delivered}
+
+
+class CaptureThread(threading.Thread):
+    """
+    Captures from an opened source into a FrameRing in the background, so
+    the analysis loop always finds the freshest frame waiting.
+    """
+
+    def __init__(self, source, slots=3, policy=LATEST):
+        super(CaptureThread, self).__init__(name="RatNavCapture")
+        self.daemon = True
+
+        self.source = source
+        self.ring = FrameRing(source.shape, slots, policy)
+        self.running = False
+        self.seq = 0
+
+        self.frame_seq = 0  # Of the frame read() returned last
+        self.frame_stamp = 0.0
+        self.frame_arrival = 0.0
+
+    def start(self):
+        self.running = True
+        super(CaptureThread, self).start()
+
+    def run(self):
+        ring = self.ring
+
+        while self.running:
+            slot = ring.acquire()
+
+            if not self.source.grab(ring.buffers[slot]):
+                ring.release(slot)
+                break
+
+            self.seq += 1
+            stamp, arrival = self.source.stamps()
+            ring.publish(slot, self.seq, stamp, arrival)
+
+        ring.close()
+
+    def read(self, timeout=None):
+        """Returns the next frame to analyse or None at the end of the stream"""
+
+        slot = self.ring.get(timeout)
+        if slot is None:
+            return None
+
+        self.frame_seq = self.ring.seqs[slot]
+        self.frame_stamp = self.ring.stamps[slot]
+        self.frame_arrival = self.ring.arrivals[slot]
+
+        return self.ring.buffers[slot]
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join(2.0)
+        self.ring.close()
+
+    def stats(self):
+        return self.ring.stats()
+
+
+def open_camera(device=0, width=640, height=480, gray=False):
+    """Picks the Pi camera if it is available or a normal cv camera"""
+
+    if PICAM:
+        return PiCameraSource(width, height, gray=gray)
+
+    return CVCamera(device, gray=gray)
+
+
+def open_source(spec, gray=False):
+    """
+    Creates a frame source from a short description, delivering luma only
+    frames with gray=True:
+
+    * camera - the Pi camera if available, otherwise the first cv camera
+    * camera:N - cv camera number N
+    * synthetic - a box that stands and goes, at 25 frames per second
+    * a directory - its images, at 10 frames per second
+    * a .npy file - a raw stream, as recorded by ratnav.recorder
+    * any other path - a video file
+    """
+
+    if spec == 'camera':
+        return open_camera(gray=gray)
+    elif spec.startswith('camera:'):
+        return CVCamera(int(spec.split(':', 1)[1]), gray=gray)
+    elif spec == 'synthetic':
+        return FakeCamera(length=1000, fps=25, phases=[(150, 0), (100, 8)], gray=gray)
+    elif os.path.isdir(spec):
+        return ImageDirectorySource(spec, gray=gray)
+    elif spec.endswith('.npy'):
+        from ratnav.recorder import StreamReader
+        return StreamReader(spec)  # Streams are replayed as recorded
+
+    return VideoFileSource(spec, gray=gray)
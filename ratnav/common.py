@@ -4,6 +4,8 @@
 This module contais some common routines used by other samples.
 '''
 
+from __future__ import print_function
+
 import numpy as np
 import cv2
 import os
@@ -79,7 +81,8 @@ def mtx2rvec(R):
     return axis * np.arctan2(s, c)
 
 
-def draw_str(dst, (x, y), s):
+def draw_str(dst, pos, s):
+    x, y = pos
     cv2.putText(dst, s, (x + 1, y + 1), cv2.FONT_HERSHEY_PLAIN, 1.0, (0, 0, 0), thickness=2, lineType=cv2.CV_AA)
     cv2.putText(dst, s, (x, y), cv2.FONT_HERSHEY_PLAIN, 1.0, (255, 255, 255), lineType=cv2.CV_AA)
 
@@ -148,12 +151,12 @@ def clock():
 
 @contextmanager
 def Timer(msg):
-    print msg, '...',
+    print(msg, '...', end=' ')
     start = clock()
     try:
         yield
     finally:
-        print "%.2f ms" % ((clock() - start) * 1000)
+        print("%.2f ms" % ((clock() - start) * 1000))
 
 
 class StatValue:
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Rate limited display
+
+Shows what RatNav sees at a capped frame rate, so an open window does
+not slow the detection down. The analysis loop asks due() every frame
+and only hands over a frame (and what to draw onto it) when the display
+wants a new one, everything else costs nothing.
+
+All HighGUI calls happen on the calling thread, which has to be the main
+thread: Cocoa on macOS crashes or hangs on windows of other threads, Qt
+warns about their timers. Window events are handled when a frame is
+shown, fps times a second.
+"""
+
+import time
+
+import cv2
+import numpy as np
+
+
+class Display(object):
+    """Renders submitted frames with overlays, at most fps times a second"""
+
+    def __init__(self, shape, fps=10, window="Image", threshold=25, on_threshold_change=None):
+        self.interval = 1.0 / fps
+        self.window = window
+        self.threshold = threshold
+        self.on_threshold_change = on_threshold_change
+
+        self.canvas = np.zeros(shape[:2] + (3,), np.uint8)  # Frames are copied and overlays drawn here, in color
+
+        self.last = 0.0
+        self.opened = False
+        self.quit = False  # Set, when the user pressed 'Esc'
+
+        self.rendered = 0
+
+    def open(self):
+        cv2.namedWindow(self.window)
+        if self.on_threshold_change is not None:
+            cv2.createTrackbar("Detection treshold: ", self.window, self.threshold, 100, self.on_threshold_change)
+        self.opened = True
+
+    def due(self):
+        """Whether the display wants a new frame, cheap to ask every frame"""
+
+        return time.time() - self.last >= self.interval
+
+    def submit(self, frame, contours=(), offset=(0, 0), rectangle=None):
+        """Shows a frame and its overlays, if the display is due"""
+
+        if not self.due():
+            return False
+
+        self.last = time.time()
+
+        if frame.ndim == 2:  # Luma frame
+            cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR, dst=self.canvas)
+        else:
+            self.canvas[:] = frame
+
+        self.render(contours, offset, rectangle)
+        cv2.imshow(self.window, self.canvas)
+        self.rendered += 1
+
+        c = cv2.waitKey(1) % 0x100
+        if c == 27 or c == 10:  # 'Esc' ends RatNav
+            self.quit = True
+
+        return True
+
+    def render(self, contours, offset, rectangle):
+        """Draws the overlays into the reused canvas"""
+
+        if rectangle is not None:
+            x, y, w, h = rectangle
+            cv2.rectangle(self.canvas, (x, y), (x + w, y + h), (0, 255, 0), 1)
+
+        if len(contours):
+            cv2.drawContours(self.canvas, contours, -1, (0, 0, 255), 2, offset=offset)
+
+    def close(self):
+        if self.opened:
+            cv2.destroyWindow(self.window)
+            self.opened = False
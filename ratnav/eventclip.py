@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Event clips
+
+Keeps the last seconds of frames as JPEGs in a fixed ring of byte
+buffers and writes the frames around an alert to disk: pre-roll from the
+ring, post-roll as it comes in. Memory use is slots times slot size, set
+once at start.
+
+The analysis loop only ever copies a frame into a staging buffer, when
+the encoder is idle and the clip frame rate allows it. Encoding and disk
+writes happen in two background threads, a busy encoder means a skipped
+clip frame, never a waiting loop.
+
+Every clip is a directory of <seq>.jpg files, which replays as an image
+directory source.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+
+
+class EventRecorder(object):
+    """Pre-roll ring of JPEG frames, flushed to disk around triggered events"""
+
+    def __init__(self, shape, directory='clips', fps=10, preroll=5.0, postroll=5.0, quality=80, slot_bytes=None):
+        self.directory = directory
+        self.interval = 1.0 / fps
+        self.preroll = preroll
+        self.postroll = postroll
+        self.params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+
+        # Room for a whole clip plus a second of slack for the writer
+        slots = int((preroll + postroll + 1.0) * fps) + 1
+        if slot_bytes is None:
+            slot_bytes = int(np.prod(shape)) // 8  # Generous for JPEGs of camera frames
+
+        self.slots = [bytearray(slot_bytes) for _ in range(slots)]
+        self.lengths = [0] * slots
+        self.seqs = [-1] * slots
+        self.stamps = [0.0] * slots
+        self.next = 0
+
+        self.staging = np.zeros(shape, np.uint8)
+        self.staged = False
+        self.staged_seq = 0
+        self.staged_stamp = 0.0
+        self.last = None
+
+        self.events = []  # (name, start, end) waiting for their post-roll
+        self.complete = deque()  # Events ready to be written
+
+        self.lock = threading.Lock()  # Guards the ring
+        self.encode_condition = threading.Condition()
+        self.write_condition = threading.Condition()
+        self.running = True  # Until close(), the writer goes on until the encoder is done
+        self.writing = True
+
+        self.encoded = 0
+        self.skipped = 0
+        self.oversized = 0
+        self.clips = 0
+        self.lost = 0  # Clip frames overwritten before they were written
+
+        self.encoder = threading.Thread(target=self.encode_loop, name="RatNavClipEncoder")
+        self.writer = threading.Thread(target=self.write_loop, name="RatNavClipWriter")
+        for thread in self.encoder, self.writer:
+            thread.daemon = True
+            thread.start()
+
+    @property
+    def memory(self):
+        """Bytes held by the ring and the staging buffer"""
+
+        return sum(len(slot) for slot in self.slots) + self.staging.nbytes
+
+    def submit(self, frame, seq, stamp):
+        """Stages the frame for encoding, if due and the encoder is idle"""
+
+        if self.last is not None and stamp - self.last < self.interval:
+            return False
+
+        if self.staged:
+            self.skipped += 1
+            return False
+
+        with self.encode_condition:
+            np.copyto(self.staging, frame)
+            self.staged_seq = seq
+            self.staged_stamp = stamp
+            self.staged = True
+            self.last = stamp
+            self.encode_condition.notify()
+
+        return True
+
+    def trigger(self, name, stamp):
+        """Records a clip from preroll seconds before to postroll seconds after stamp"""
+
+        with self.lock:
+            self.events.append((name, stamp - self.preroll, stamp + self.postroll))
+
+    def encode_loop(self):
+        while True:
+            with self.encode_condition:
+                while self.running and not self.staged:
+                    self.encode_condition.wait()
+                if not self.staged:
+                    break
+                seq, stamp = self.staged_seq, self.staged_stamp
+
+                ok, encoded = cv2.imencode('.jpg', self.staging, self.params)
+                self.staged = False
+
+            if ok:
+                self.store(encoded, seq, stamp)
+
+            self.complete_events(stamp)
+
+        self.complete_events(None)  # Closing, write what we have
+
+    def store(self, encoded, seq, stamp):
+        """Copies an encoded frame into the oldest ring slot"""
+
+        length = encoded.size
+        with self.lock:
+            slot = self.next
+            if length > len(self.slots[slot]):
+                self.oversized += 1
+                return
+
+            self.slots[slot][:length] = encoded.data
+            self.lengths[slot] = length
+            self.seqs[slot] = seq
+            self.stamps[slot] = stamp
+            self.next = (slot + 1) % len(self.slots)
+            self.encoded += 1
+
+    def complete_events(self, stamp):
+        """Hands events whose post-roll has passed (all with stamp None) to the writer"""
+
+        with self.lock:
+            done = [event for event in self.events if stamp is None or event[2] <= stamp]
+            if not done:
+                return
+            self.events = [event for event in self.events if event not in done]
+
+        with self.write_condition:
+            self.complete.extend(done)
+            self.write_condition.notify()
+
+    def write_loop(self):
+        while True:
+            with self.write_condition:
+                while self.writing and not self.complete:
+                    self.write_condition.wait()
+                if not self.complete:
+                    break
+                event = self.complete.popleft()
+
+            self.write(*event)
+
+    def write(self, name, start, end):
+        """Writes the ring frames between start and end into a clip directory"""
+
+        with self.lock:
+            frames = sorted((self.seqs[slot], slot) for slot in range(len(self.slots))
+                            if self.seqs[slot] >= 0 and start <= self.stamps[slot] <= end)
+
+        if not frames:
+            return
+
+        # Named after the first frame, clips of the same second stay apart
+        path = os.path.join(self.directory, "%s-%08i-%s" % (time.strftime("%Y%m%d-%H%M%S"), frames[0][0], name))
+        os.makedirs(path)
+
+        for seq, slot in frames:
+            with self.lock:  # Copy out, the encoder may reuse the slot meanwhile
+                if self.seqs[slot] != seq:
+                    self.lost += 1
+                    continue
+                data = bytes(self.slots[slot][:self.lengths[slot]])
+
+            with open(os.path.join(path, "%08i.jpg" % seq), 'wb') as f:
+                f.write(data)
+
+        self.clips += 1
+
+    def close(self):
+        """Writes the pending clips, with the post-roll collected so far"""
+
+        with self.encode_condition:
+            self.running = False
+            self.encode_condition.notify()
+        self.encoder.join()
+
+        with self.write_condition:
+            self.writing = False
+            self.write_condition.notify()
+        self.writer.join()
+
+    def stats(self):
+        return {'encoded': self.encoded,
+                'skipped': self.skipped,
+                'oversized': self.oversized,
+                'clips': self.clips,
+                'lost': self.lost}
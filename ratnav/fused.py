@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Fused motion kernel
+
+The contour processor updates the background, diffs the smoothed frame
+against it, converts the difference to gray and thresholds it in four
+or more full frame passes, each reading and writing every pixel again.
+With numba installed, kernel() gives a function that does all of that
+in one pass over the pixels, while they are in cache. Without numba the
+processor keeps running its OpenCV passes, which give the same mask.
+The kernel is scalar code, OpenCV's vectorized passes may still be
+faster for color frames, measure on the target before switching.
+
+The kernels follow OpenCV's arithmetic: accumulateWeighted in float32,
+convertScaleAbs rounding half to even and BGR2GRAY with its 14 bit fixed
+point weights (1868, 9617, 4899) plus rounding. The fixed point model is
+plain integer math. traffic() estimates the memory traffic per pixel of
+both ways, see 'python -m ratnav.bench fused'.
+"""
+
+import numpy as np
+
+from ratnav.background import FixedPointBackground
+
+try:
+    import numba
+
+    NUMBA = True
+except ImportError:
+    NUMBA = False
+
+WEIGHTS = (1868, 9617, 4899)  # cv2.COLOR_BGR2GRAY in 14 bit fixed point
+
+
+def _float_luma(image, average, reference, mask, alpha, threshold):
+    height, width = mask.shape
+    a = np.float32(alpha)
+    b = np.float32(1.0) - a
+
+    for y in range(height):
+        for x in range(width):
+            pixel = np.int32(image[y, x, 0])
+            value = average[y, x, 0] * b + np.float32(pixel) * a
+            average[y, x, 0] = value
+            level = np.int32(np.rint(value))  # An average of bytes needs no clamping
+            reference[y, x, 0] = level
+            mask[y, x] = 255 if abs(pixel - level) > threshold else 0
+
+
+def _float_color(image, average, reference, mask, alpha, threshold):
+    height, width = mask.shape
+    a = np.float32(alpha)
+    b = np.float32(1.0) - a
+
+    for y in range(height):
+        for x in range(width):
+            gray = np.int32(8192)
+            for c in range(3):
+                pixel = np.int32(image[y, x, c])
+                value = average[y, x, c] * b + np.float32(pixel) * a
+                average[y, x, c] = value
+                level = np.int32(np.rint(value))
+                reference[y, x, c] = level
+                gray += abs(pixel - level) * WEIGHTS[c]
+            mask[y, x] = 255 if gray >> 14 > threshold else 0
+
+
+def _fixed_luma(image, average, reference, shift, mask, threshold):
+    height, width = mask.shape
+    up = 8 - shift
+
+    for y in range(height):
+        for x in range(width):
+            pixel = np.int32(image[y, x, 0])
+            value = np.int32(average[y, x, 0])
+            value += (pixel << up) - (value >> shift)
+            average[y, x, 0] = value
+            level = value >> 8
+            reference[y, x, 0] = level
+            mask[y, x] = 255 if abs(pixel - level) > threshold else 0
+
+
+def _fixed_color(image, average, reference, shift, mask, threshold):
+    height, width = mask.shape
+    up = 8 - shift
+
+    for y in range(height):
+        for x in range(width):
+            gray = np.int32(8192)
+            for c in range(3):
+                pixel = np.int32(image[y, x, c])
+                value = np.int32(average[y, x, c])
+                value += (pixel << up) - (value >> shift)
+                average[y, x, c] = value
+                level = value >> 8
+                reference[y, x, c] = level
+                gray += abs(pixel - level) * WEIGHTS[c]
+            mask[y, x] = 255 if gray >> 14 > threshold else 0
+
+
+if NUMBA:
+    _float_luma, _float_color, _fixed_luma, _fixed_color = [numba.njit(nogil=True, cache=True)(function) for function in
+                                                            (_float_luma, _float_color, _fixed_luma, _fixed_color)]
+
+
+def _planes(image):
+    """A view with an explicit channel axis"""
+
+    return image.reshape(image.shape[:2] + (-1,))
+
+
+def kernel(background):
+    """
+    The fused update, diff, gray and threshold pass for the background
+    model, called as kernel(image, mask, threshold). None without numba,
+    the processor then runs its OpenCV passes.
+    """
+
+    if not NUMBA:
+        return None
+
+    average = _planes(background.average)
+    reference = _planes(background.reference)
+    color = average.shape[2] != 1
+
+    if isinstance(background, FixedPointBackground):
+        shift = background.shift
+        motion = _fixed_color if color else _fixed_luma
+
+        def fixed(image, mask, threshold):
+            motion(_planes(image), average, reference, shift, mask, threshold)
+
+        return fixed
+
+    alpha = background.alpha
+    motion = _float_color if color else _float_luma
+
+    def floating(image, mask, threshold):
+        motion(_planes(image), average, reference, mask, alpha, threshold)
+
+    return floating
+
+
+def traffic(channels=3, model='float', fused=False):
+    """Estimated bytes read and written per pixel, from background update to mask"""
+
+    state = 4 if model == 'float' else 2  # Bytes per channel of the average
+
+    if fused:
+        # Image in, average in and out, reference out (for snapshots), mask out
+        return channels + 2 * state * channels + channels + 1
+
+    if model == 'float':
+        update = channels + 2 * state * channels  # accumulateWeighted
+        update += state * channels + channels  # convertScaleAbs to the reference
+    else:
+        # Four numpy passes: shift, subtract, shift the image, add, then the reference
+        update = (2 * state + 3 * state + (1 + state) + 3 * state + (state + 1)) * channels
+
+    diff = 3 * channels
+    gray = channels + 1 if channels != 1 else 0
+
+    return update + diff + gray + 2  # The threshold reads and writes one byte each
@@ -1,8 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-import time
+"""
+RatNav logging
+
+log() only checks the level and queues the raw items, formatting and
+writing happens in a background thread, which batches everything
+queued and writes it every flush interval, or right away for errors.
+The log file is kept open in append mode, so logrotate's copytruncate
+just makes the next batch start at the top of the truncated file.
+
+Usage:
+> log("Frames captured:", captured, lvl=debug)
+"""
+
+import atexit
+import os
 import sys
+import threading
+import time
+from collections import deque
 
 debug = 10
 info = 20
@@ -23,42 +40,101 @@ count = 0
 logfile = "/var/log/ratnav/service.log"
 verbosity = {'global': debug,
              'file': off,
-             'console': debug}
+             'console': info}
+
+interval = 1.0  # Seconds between writes of queued messages
 
 start = time.time()
 
+_queue = deque()  # (lvl, time, items), appending needs no lock
+_wakeup = threading.Event()
+_write_lock = threading.Lock()  # Only taken by writers, never by log()
+_writer = None
+_fd = None
+
 
 def log(*what, **kwargs):
-    if 'lvl' in kwargs:
-        lvl = kwargs['lvl']
-        if lvl < verbosity['global']:
-            return
-    else:
-        lvl = info
+    lvl = kwargs.get('lvl', info)
+
+    # Filter first, nothing else happens for dropped messages
+    if lvl < verbosity['global'] or (lvl < verbosity['file'] and lvl < verbosity['console']):
+        return
+
+    _queue.append((lvl, time.time(), what))
+
+    if _writer is None:
+        _start_writer()
+
+    if lvl >= error:
+        _wakeup.set()
+
+
+def _start_writer():
+    global _writer
+
+    with _write_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, name="RatNavLog")
+            _writer.daemon = True
+            _writer.start()
 
+
+def _write_loop():
+    while True:
+        _wakeup.wait(interval)
+        _wakeup.clear()
+        flush()
+
+
+def _format(lvl, stamp, what):
     global count
-    global start
     count += 1
 
-    now = time.time() - start
-    msg = "[%s] : %5s : %.5f : %5i :" % (time.asctime(),
+    msg = "[%s] : %5s : %.5f : %5i :" % (time.asctime(time.localtime(stamp)),
                                          lvldata[lvl][0],
-                                         now,
+                                         stamp - start,
                                          count)
 
     for thing in what:
         msg += " "
         msg += str(thing)
 
-    if lvl >= verbosity['file']:
-        try:
-            f = open(logfile, "a")
-            f.write(msg)
-            f.flush()
-            f.close()
-        except IOError:
-            print("Can't open logfile for writing!")
-            sys.exit(23)
-
-    if lvl >= verbosity['console']:
-        print(lvldata[lvl][1], str(msg), '\033[0m')
\ No newline at end of file
+    return msg
+
+
+def _write_file(lines):
+    global _fd
+
+    try:
+        if _fd is None:
+            _fd = os.open(logfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(_fd, "".join(lines).encode('utf-8'))
+    except (IOError, OSError) as e:
+        verbosity['file'] = off
+        sys.stderr.write("Can't write logfile %s, file logging disabled: %s\n" % (logfile, e))
+
+
+def flush():
+    """Formats and writes all queued messages"""
+
+    with _write_lock:
+        console = []
+        lines = []
+
+        while _queue:
+            lvl, stamp, what = _queue.popleft()
+            msg = _format(lvl, stamp, what)
+
+            if lvl >= verbosity['file']:
+                lines.append(msg + "\n")
+            if lvl >= verbosity['console']:
+                console.append("%s %s \033[0m\n" % (lvldata[lvl][1], msg))
+
+        if lines:
+            _write_file(lines)
+        if console:
+            sys.stdout.write("".join(console))
+            sys.stdout.flush()
+
+
+atexit.register(flush)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Motion metrics
+
+Whole-frame or region-of-interest pixel counts on binary motion masks.
+Every metric is a single cv2.countNonZero call on a view of the mask, so
+no per-pixel python code runs, whatever the resolution.
+"""
+
+import cv2
+import numpy as np
+
+
+def crop(mask, rect=None):
+    """Returns a view of mask restricted to rect (x, y, w, h) or the whole mask"""
+
+    mask = np.asarray(mask)
+
+    if rect is None:
+        return mask
+
+    x, y, w, h = [int(v) for v in rect]
+    return mask[y:y + h, x:x + w]
+
+
+def count_set(mask, rect=None):
+    """Counts non-zero pixels in the mask (or rect)"""
+
+    return cv2.countNonZero(crop(mask, rect))
+
+
+def count_black(mask, rect=None):
+    """Counts zero (black) pixels in the mask (or rect)"""
+
+    view = crop(mask, rect)
+
+    return view.size - cv2.countNonZero(view)
+
+
+def set_percentage(mask, rect=None):
+    """Percentage of non-zero pixels in the mask (or rect)"""
+
+    view = crop(mask, rect)
+    if view.size == 0:
+        return 0.0
+
+    return (cv2.countNonZero(view) * 100.0) / view.size
+
+
+def black_percentage(mask, rect=None):
+    """Percentage of zero (black) pixels in the mask (or rect)"""
+
+    view = crop(mask, rect)
+    if view.size == 0:
+        return 0.0
+
+    return ((view.size - cv2.countNonZero(view)) * 100.0) / view.size
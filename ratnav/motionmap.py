@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Block grid motion map
+
+Reduces a motion mask to a coarse grid of cells, each holding the mean
+mask value of its pixels, and builds the integral image of that grid.
+Asking how much motion a rectangle contains then costs four lookups,
+however large the rectangle and however many contours the mask has.
+
+Usage:
+> motionmap = MotionMap((640, 480), cell=16)
+> motionmap.update(mask)  # Once per frame
+> motionmap.percentage((160, 120, 320, 240))
+"""
+
+import cv2
+import numpy as np
+
+
+class MotionMap(object):
+    """
+    Cell grid plus integral image of a motion mask.
+
+    With inverted=True black mask pixels count as motion, as in the
+    threshold mode.
+    """
+
+    def __init__(self, size, cell=16, inverted=False):
+        width, height = size
+        self.size = size
+        self.inverted = inverted
+
+        self.columns = max(1, width // cell)
+        self.rows = max(1, height // cell)
+
+        self.cells = np.zeros((self.rows, self.columns), np.uint8)
+        self.integral = np.zeros((self.rows + 1, self.columns + 1), np.int32)
+
+    def update(self, mask):
+        """Builds the grid and its integral from the current mask"""
+
+        cv2.resize(mask, (self.columns, self.rows), dst=self.cells, interpolation=cv2.INTER_AREA)
+        cv2.integral(self.cells, self.integral)
+
+    def cell_bounds(self, rect):
+        """Cell columns and rows (x0, y0, x1, y1) covering the pixel rectangle"""
+
+        width, height = self.size
+        x, y, w, h = rect
+
+        x0 = min(max(int(round(x * self.columns / float(width))), 0), self.columns - 1)
+        y0 = min(max(int(round(y * self.rows / float(height))), 0), self.rows - 1)
+        x1 = min(max(int(round((x + w) * self.columns / float(width))), x0 + 1), self.columns)
+        y1 = min(max(int(round((y + h) * self.rows / float(height))), y0 + 1), self.rows)
+
+        return x0, y0, x1, y1
+
+    def amount(self, rect=None):
+        """Summed cell values (255 per fully moving cell) in the rectangle"""
+
+        if rect is None:
+            x0, y0, x1, y1 = 0, 0, self.columns, self.rows
+        else:
+            x0, y0, x1, y1 = self.cell_bounds(rect)
+
+        integral = self.integral
+        total = int(integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0])
+
+        if self.inverted:
+            total = 255 * (x1 - x0) * (y1 - y0) - total
+
+        return total
+
+    def percentage(self, rect=None):
+        """Percentage of motion in the rectangle (or the whole frame)"""
+
+        if rect is None:
+            cells = self.columns * self.rows
+        else:
+            x0, y0, x1, y1 = self.cell_bounds(rect)
+            cells = (x1 - x0) * (y1 - y0)
+
+        return (self.amount(rect) * 100.0) / (255 * cells)
+
+    def any(self, rect=None):
+        """Whether there is any motion in the rectangle"""
+
+        return self.amount(rect) > 0
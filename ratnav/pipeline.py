@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Motion detection pipelines
+
+Both processors allocate all their intermediate images once, when they
+are constructed, and pass them as dst= outputs to the cv2 functions, so
+processing a frame does not allocate any image memory.
+
+Processors can work on a downscaled pyramid level of the captured frame
+(scale 2 processes a quarter, scale 4 a sixteenth of the pixels). Their
+masks, rectangles and contours are then in processing coordinates, use
+to_processing() and to_frame() to convert between both.
+
+A Cascade puts a cheap ChangeGate in front of a processor, so the full
+pipeline only runs on frames that differ from the last processed one.
+
+Set a StageTimer as the timer attribute to time the individual stages.
+"""
+
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from ratnav.background import MODELS
+from ratnav.logger import log, warn
+from ratnav.morphology import KERNEL, Morphology
+from ratnav.timing import NULL_TIMER
+
+
+_warned_unfused = False  # Whether the missing fused kernel was logged
+
+
+def find_contours(mask):
+    """Outer contours of a binary mask, whatever cv2 version is installed"""
+
+    # cv2 3.x returns (image, contours, hierarchy), the others (contours, hierarchy)
+    return cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+
+def image_shape(width, height, channels=3):
+    """Array shape of an image, single channel images are 2D"""
+
+    if channels == 1:
+        return height, width
+
+    return height, width, channels
+
+
+class Pyramid(object):
+    """Reduces frames by a power of two with preallocated pyrDown levels"""
+
+    def __init__(self, size, scale=1, channels=3):
+        if scale < 1 or scale & (scale - 1):
+            raise ValueError("Processing scale must be a power of two: %s" % scale)
+
+        self.scale = scale
+        self.frame_size = size
+        self.levels = []
+
+        width, height = size
+        while scale > 1:
+            width, height = (width + 1) // 2, (height + 1) // 2
+            self.levels.append(np.zeros(image_shape(width, height, channels), np.uint8))
+            scale //= 2
+
+        self.size = width, height
+
+    def reduce(self, frame):
+        """Returns the frame at processing scale"""
+
+        for level in self.levels:
+            cv2.pyrDown(frame, dst=level, dstsize=(level.shape[1], level.shape[0]))
+            frame = level
+
+        return frame
+
+    def to_processing(self, rect):
+        """Maps a rectangle (x, y, w, h) from frame to processing coordinates"""
+
+        return tuple(int(v) // self.scale for v in rect)
+
+    def to_frame(self, contours):
+        """Maps contours from processing to frame coordinates"""
+
+        if self.scale == 1:
+            return contours
+
+        return [contour * self.scale for contour in contours]
+
+
+def _warn_unfused():
+    """Logs once, that the fused kernel was asked for but can't be used"""
+
+    global _warned_unfused
+
+    if not _warned_unfused:
+        log("Fused motion kernel requested, but numba is not installed, using the OpenCV passes", lvl=warn)
+        _warned_unfused = True
+
+
+class ContourProcessor(object):
+    """
+    Running average background subtraction.
+
+    Smooths the frame, updates the running average, diffs the frame against
+    it and thresholds the gray difference into a mask of dilated and eroded
+    motion blobs. The dilate and erode radii are given at frame scale and
+    shrink with the processing scale, to produce the same blobs.
+
+    With channels=1 it works on luma frames, the whole model is a single
+    channel and the difference needs no gray conversion. The background
+    model is 'float' or 'fixed' point, see ratnav.background. With fused
+    set and numba installed, background update, diff, gray conversion and
+    threshold run as one pass, see ratnav.fused.
+    """
+
+    empty = 0  # Mask value without motion
+
+    def __init__(self, size, alpha=0.05, diff_threshold=50, dilate=15, erode=10, scale=1,
+                 morphology=KERNEL, shape='rect', channels=3, background='float', fused=False):
+        if background not in MODELS:
+            raise ValueError("Unknown background model: %s" % background)
+
+        self.pyramid = Pyramid(size, scale, channels)
+        self.scale = scale
+        self.channels = channels
+        self.frame_size = size
+        self.size = width, height = self.pyramid.size
+        self.alpha = alpha
+        self.diff_threshold = diff_threshold
+        self.dilate = max(1, int(round(dilate / float(scale))))
+        self.erode = max(1, int(round(erode / float(scale))))
+
+        self.morphology = Morphology(self.size, self.dilate, self.erode, morphology, shape)
+        self.timer = NULL_TIMER
+
+        self.blurred = np.zeros(image_shape(width, height, channels), np.uint8)
+        self.background = MODELS[background](image_shape(width, height, channels), alpha)
+        self.reference = self.background.reference
+        self.gray = np.zeros((height, width), np.uint8)
+        # A luma difference is the gray difference already
+        self.absdiff = self.gray if channels == 1 else np.zeros((height, width, channels), np.uint8)
+        self.mask = np.zeros((height, width), np.uint8)
+        self.scratch = np.zeros((height, width), np.uint8)
+
+        self.fused = None
+        if fused:
+            from ratnav.fused import kernel
+
+            self.fused = kernel(self.background)  # None without numba
+            if self.fused is None:
+                _warn_unfused()
+
+        self.primed = False
+
+    def reset(self):
+        """Forgets the background, the next frame starts a new one"""
+
+        self.primed = False
+
+    def state(self):
+        """The background model, as 8 bit image"""
+
+        return {'background': self.reference}
+
+    def restore(self, state):
+        """Continues with a stored background, if it fits, the next frame updates it"""
+
+        background = state.get('background')
+        if background is None or background.shape != self.reference.shape:
+            return False
+
+        self.background.prime(background)
+        self.primed = True
+
+        return True
+
+    def smooth(self, frame):
+        """Reduces and blurs the frame into blurred"""
+
+        timer = self.timer
+        t = timer.start()
+
+        frame = self.pyramid.reduce(frame)
+        t = timer.lap('pyramid', t)
+
+        cv2.GaussianBlur(frame, (3, 3), 0, dst=self.blurred)  # Remove false positives
+        return timer.lap('smooth', t)
+
+    def learn(self, frame):
+        """Only updates the background with the frame, for frames without a mask"""
+
+        self.update_background(self.smooth(frame))
+
+    def update_background(self, t):
+        """Updates the background with blurred, the first frame starts it"""
+
+        if not self.primed:
+            self.background.prime(self.blurred)
+            self.primed = True
+        else:
+            self.background.update(self.blurred)
+
+        return self.timer.lap('background', t)
+
+    def process(self, frame):
+        """Returns the motion mask of the given frame"""
+
+        timer = self.timer
+        t = self.smooth(frame)
+
+        if self.fused is not None and self.primed:
+            self.fused(self.blurred, self.mask, self.diff_threshold)
+            t = timer.lap('fused', t)
+        else:
+            t = self.motion(t)
+
+        self.morphology.apply(self.mask)  # to get object blobs
+        timer.lap('morphology', t)
+
+        return self.mask
+
+    def motion(self, t):
+        """Updates the background and thresholds the difference into the mask, one OpenCV pass each"""
+
+        timer = self.timer
+        t = self.update_background(t)
+
+        cv2.absdiff(self.blurred, self.reference, dst=self.absdiff)
+        t = timer.lap('diff', t)
+
+        if self.channels != 1:
+            cv2.cvtColor(self.absdiff, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        cv2.threshold(self.gray, self.diff_threshold, 255, cv2.THRESH_BINARY, dst=self.mask)
+
+        return timer.lap('threshold', t)
+
+    def contours(self):
+        """Outer contours of the current mask"""
+
+        t = self.timer.start()
+
+        self.scratch[:] = self.mask  # Older cv2 versions modify their input
+        contours = find_contours(self.scratch)
+
+        self.timer.lap('contours', t)
+
+        return contours
+
+    def to_processing(self, rect):
+        return self.pyramid.to_processing(rect)
+
+    def to_frame(self, contours):
+        return self.pyramid.to_frame(contours)
+
+
+class ThresholdProcessor(object):
+    """
+    Reference frame differencing.
+
+    Diffs the gray frame against the very first one and thresholds the
+    smoothed and morphologically cleaned difference, inverted: unchanged
+    pixels end up white (255), changed ones black. Luma frames
+    (channels=1) are used as they are.
+    """
+
+    empty = 255  # Mask value without motion
+
+    def __init__(self, size, diff_threshold=10, scale=1, channels=3):
+        self.pyramid = Pyramid(size, scale, channels)
+        self.scale = scale
+        self.channels = channels
+        self.frame_size = size
+        self.size = width, height = self.pyramid.size
+        self.diff_threshold = diff_threshold
+
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+        self.timer = NULL_TIMER
+
+        self.reference = np.zeros((height, width), np.uint8)  # Gray frame at t-1
+        self.gray = np.zeros((height, width), np.uint8)  # Gray frame at t
+        self.mask = np.zeros((height, width), np.uint8)
+        self.scratch = np.zeros((height, width), np.uint8)
+
+        self.primed = False
+
+    def reset(self):
+        self.primed = False
+
+    def state(self):
+        return {'background': self.reference}
+
+    def restore(self, state):
+        """Uses a stored reference frame, if it fits"""
+
+        background = state.get('background')
+        if background is None or background.shape != self.reference.shape:
+            return False
+
+        self.reference[:] = background
+        self.primed = True
+
+        return True
+
+    def process(self, frame):
+        """Returns the inverted thresholded difference, black where the frame changed"""
+
+        timer = self.timer
+        t = timer.start()
+
+        frame = self.pyramid.reduce(frame)
+        t = timer.lap('pyramid', t)
+
+        if self.channels == 1:
+            gray = frame
+        else:
+            gray = self.gray
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+
+        if not self.primed:
+            self.reference[:] = gray
+            self.primed = True
+        t = timer.lap('gray', t)
+
+        # Absdiff to get the difference between to the frames
+        cv2.absdiff(self.reference, gray, dst=self.mask)
+        t = timer.lap('diff', t)
+
+        # Remove the noise and do the threshold
+        cv2.blur(self.mask, (5, 5), dst=self.scratch)
+        t = timer.lap('smooth', t)
+
+        cv2.morphologyEx(self.scratch, cv2.MORPH_OPEN, self.kernel, dst=self.mask)
+        cv2.morphologyEx(self.mask, cv2.MORPH_CLOSE, self.kernel, dst=self.scratch)
+        t = timer.lap('morphology', t)
+
+        cv2.threshold(self.scratch, self.diff_threshold, 255, cv2.THRESH_BINARY_INV, dst=self.mask)
+        timer.lap('threshold', t)
+
+        return self.mask
+
+    def learn(self, frame):
+        """Nothing to learn, the reference stays the first frame"""
+
+    def to_processing(self, rect):
+        return self.pyramid.to_processing(rect)
+
+    def to_frame(self, contours):
+        return self.pyramid.to_frame(contours)
+
+
+class ChangeGate(object):
+    """
+    Decides whether a frame changed at all, by comparing a tiny thumbnail
+    against the thumbnail of the last frame that passed the gate.
+    """
+
+    def __init__(self, threshold=1.0, thumbnail=(32, 24), channels=3):
+        width, height = thumbnail
+        self.threshold = threshold
+        self.thumbnail = np.zeros(image_shape(width, height, channels), np.uint8)
+        self.reference = np.zeros(image_shape(width, height, channels), np.uint8)
+        self.difference = 0.0
+        self.primed = False
+
+    def reset(self):
+        self.primed = False
+
+    def check(self, frame):
+        """True, if the mean absolute thumbnail difference exceeds the threshold"""
+
+        cv2.resize(frame, (self.thumbnail.shape[1], self.thumbnail.shape[0]), dst=self.thumbnail,
+                   interpolation=cv2.INTER_AREA)
+
+        if self.primed:
+            self.difference = cv2.norm(self.thumbnail, self.reference, cv2.NORM_L1) / self.thumbnail.size
+            if self.difference <= self.threshold:
+                return False
+
+        self.reference[:] = self.thumbnail
+        self.primed = True
+
+        return True
+
+
+class Cascade(object):
+    """
+    Tiered detector around a processor.
+
+    Every frame passes the cheap change gate first. Only if it fires the
+    processor runs the expensive diff and morphology stages, otherwise the
+    mask is reported empty. The background learns from every frame
+    though, the gate compares against the last frame that passed, not
+    against the background, which still has to catch up with it. Contours are the last stage and
+    only traced on demand. Hits per stage are counted, see hit_rates().
+    """
+
+    def __init__(self, processor, threshold=1.0, thumbnail=(32, 24)):
+        self.processor = processor
+        self.gate = ChangeGate(threshold, thumbnail, processor.channels)
+        self.mask = processor.mask
+        self.quiet = False
+        self.cleared = False
+
+        self.stages = OrderedDict([('frames', 0), ('pipeline', 0), ('contours', 0)])
+
+    def __getattr__(self, name):
+        # Everything else (size, scale, to_frame(), ...) is the processors'
+        return getattr(self.processor, name)
+
+    def reset(self):
+        self.processor.reset()
+        self.gate.reset()
+
+    def process(self, frame):
+        """Returns the motion mask, empty if the gate did not fire"""
+
+        stages = self.stages
+        stages['frames'] += 1
+
+        t = self.timer.start()
+        passed = self.gate.check(frame)
+        self.timer.lap('gate', t)
+
+        if passed:
+            stages['pipeline'] += 1
+            self.quiet = self.cleared = False
+            return self.processor.process(frame)
+
+        self.processor.learn(frame)  # Keeps alpha per frame
+
+        self.quiet = True
+        if not self.cleared:  # Static scenes need the mask cleared only once
+            self.mask.fill(self.processor.empty)
+            self.cleared = True
+
+        return self.mask
+
+    def contours(self):
+        if self.quiet:
+            return []
+
+        self.stages['contours'] += 1
+        return self.processor.contours()
+
+    def hit_rates(self):
+        """Share of all frames that reached each stage after the gate"""
+
+        frames = float(max(1, self.stages['frames']))
+        return OrderedDict((stage, hits / frames) for stage, hits in self.stages.items() if stage != 'frames')
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Raw frame streams
+
+A stream is a pair of preallocated, memory mapped .npy files: the frames
+(capacity x height x width x channels, uint8) and one metadata record
+per frame (sequence id, capture time and the metrics of the frame).
+Unwritten records have a sequence id of -1, so a stream that was cut
+short is still readable.
+
+StreamWriter copies frames into a small pool of slots and leaves the
+copying into the mapping to a background thread, so the capture loop
+never waits for the disk. Without a given capacity a stream holds as
+many frames as fit into BUDGET bytes, a mapping that fits the 32 bit
+address space of a Pi next to everything else (and onto its SD card).
+At 640x480 that is about 11 s at 25 fps in color, 35 s in luma. StreamReader maps a stream back and hands out
+views into the mapping, without decoding or copying anything.
+
+Usage:
+> writer = StreamWriter('drive.npy', frame.shape)
+> writer.add(frame, seq, stamp, coverage, moving)
+> writer.close()
+> python -m ratnav.bench replay drive.npy
+"""
+
+import threading
+
+import numpy as np
+
+from ratnav.capture import DROP_OLDEST, FrameRing, FrameSource
+from ratnav.common import clock
+
+META_DTYPE = np.dtype([('seq', '<i8'),  # Sequence id of the frame, -1 for unwritten records
+                       ('stamp', '<f8'),  # Capture time
+                       ('coverage', '<f4'),  # Percentage of the frame in motion
+                       ('moving', 'u1')])  # The moving state after the frame
+
+BUDGET = 256 * 1024 * 1024  # Default size of the frames of a stream in bytes
+
+
+def meta_path(path):
+    """Path of the metadata file belonging to a stream"""
+
+    if path.endswith('.npy'):
+        path = path[:-len('.npy')]
+
+    return path + '.meta.npy'
+
+
+def capacity_for(shape, budget=BUDGET):
+    """Number of frames of the given shape that fit into budget bytes"""
+
+    return max(1, budget // int(np.prod(shape)))
+
+
+class StreamWriter(threading.Thread):
+    """
+    Records frames of one shape into a preallocated stream.
+
+    When the writer falls behind, the oldest queued frames are dropped,
+    once the stream is full, further frames are not recorded.
+    """
+
+    def __init__(self, path, shape, capacity=None, slots=4):
+        super(StreamWriter, self).__init__(name="RatNavRecorder")
+        self.daemon = True
+
+        if capacity is None:
+            capacity = capacity_for(shape)
+
+        self.path = path
+        self.capacity = capacity
+
+        self.frames = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(capacity,) + tuple(shape))
+        self.meta = np.lib.format.open_memmap(meta_path(path), mode='w+', dtype=META_DTYPE, shape=(capacity,))
+        self.meta['seq'] = -1
+
+        self.ring = FrameRing(shape, slots, DROP_OLDEST)
+        self.metrics = [(0.0, False)] * slots  # Travel with the frame in their slot
+
+        self.count = 0
+        self.overflow = 0  # Frames not queued, as the stream was full
+        self.late = 0  # Frames queued, while the last slots were written
+
+        self.start()
+
+    def add(self, frame, seq, stamp, coverage=0.0, moving=False):
+        """Queues a copy of the frame and its metrics for writing"""
+
+        if self.count >= self.capacity:  # Full, don't bother copying
+            self.overflow += 1
+            return
+
+        ring = self.ring
+
+        slot = ring.acquire()
+        np.copyto(ring.buffers[slot], frame)
+        self.metrics[slot] = (coverage, moving)
+        ring.publish(slot, seq, stamp)
+
+    def run(self):
+        ring = self.ring
+
+        while True:
+            slot = ring.get()
+            if slot is None:  # Closed and drained
+                break
+
+            if self.count >= self.capacity:
+                self.late += 1
+                continue
+
+            index = self.count
+            np.copyto(self.frames[index], ring.buffers[slot])
+            coverage, moving = self.metrics[slot]
+            self.meta[index] = (ring.seqs[slot], ring.stamps[slot], coverage, moving)
+            self.count += 1
+
+    def close(self):
+        """Writes out all queued frames and flushes the stream"""
+
+        self.ring.close()
+        if self.is_alive():
+            self.join()
+
+        self.frames.flush()
+        self.meta.flush()
+
+    def stats(self):
+        """Counts of recorded frames and of those dropped on the way"""
+
+        stats = self.ring.stats()
+
+        return {'recorded': self.count,
+                'dropped': stats['dropped'],
+                'overflow': self.overflow + self.late}
+
+
+class StreamReader(FrameSource):
+    """
+    Replays a recorded stream with its original sequence ids and capture
+    times. read() returns read only views into the mapping.
+    """
+
+    live = False
+
+    def __init__(self, path):
+        super(StreamReader, self).__init__(None, None)
+        self.path = path
+        self.frames = None
+        self.meta = None
+        self.length = 0
+        self.index = 0
+
+    @property
+    def shape(self):
+        return self.frames.shape[1:]
+
+    def open(self):
+        self.frames = np.load(self.path, mmap_mode='r')
+        self.meta = np.load(meta_path(self.path), mmap_mode='r')
+
+        self.length = int(np.count_nonzero(self.meta['seq'] >= 0))  # Records are written in order
+        self.height, self.width = self.frames.shape[1:3]
+        self.gray = self.frames.ndim == 3  # Recorded from a luma source
+        self.index = 0
+
+    def close(self):
+        # Dropping the last references unmaps the files
+        self.frames = None
+        self.meta = None
+
+    def grab(self, out):
+        if self.index >= self.length:
+            return False
+
+        np.copyto(out, self.frames[self.index])
+        self.index += 1
+
+        return True
+
+    def timestamp(self):
+        return float(self.meta['stamp'][self.index - 1])
+
+    def read(self, out=None):
+        """Returns a view of the next frame (or a copy in out) or None"""
+
+        if out is not None:
+            frame = out if self.grab(out) else None
+        elif self.index < self.length:
+            frame = self.frames[self.index]
+            self.index += 1
+        else:
+            frame = None
+
+        if frame is None:
+            return None
+
+        self.frame_seq = int(self.meta['seq'][self.index - 1])
+        self.frame_stamp = self.timestamp()
+        self.frame_arrival = clock()
+
+        return frame
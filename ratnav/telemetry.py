@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Per frame telemetry
+
+Every frame writes one row into preallocated numpy columns (sequence id,
+capture time, motion coverage, inner rectangle coverage, state and the
+latest stage timings in milliseconds). There are two sets of columns:
+once a set is full, or the flush interval has passed, the loop switches
+to the other one and a background thread appends the rows to a binary
+file.
+
+The file is a short header describing the record layout followed by the
+raw records, load() maps it straight into a numpy record array:
+> rows = load('drive.tlm')
+> rows['coverage'][rows['state'] == MOVING].mean()
+"""
+
+import json
+import struct
+import threading
+
+import numpy as np
+
+# States
+STANDING = 0
+STARTING = 1  # Movement seen, but not long enough to count as moving
+MOVING = 2
+
+MAGIC = b'RATNAVTM'
+
+FIELDS = [('seq', '<i8'),
+          ('stamp', '<f8'),
+          ('coverage', '<f4'),
+          ('inner', '<f4'),
+          ('state', 'u1')]
+
+
+def telemetry_dtype(stages=()):
+    """Record layout, with one millisecond column per stage"""
+
+    return np.dtype(FIELDS + [(stage, '<f4') for stage in stages])
+
+
+def load(path):
+    """Reads a telemetry file into a record array"""
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError("%s is no telemetry file" % path)
+
+        length, = struct.unpack('<I', f.read(4))
+        descr = json.loads(f.read(length).decode('ascii'))
+        dtype = np.dtype([(str(name), str(kind)) for name, kind in descr])
+
+        return np.fromfile(f, dtype)
+
+
+class Telemetry(threading.Thread):
+    """
+    Fixed capacity telemetry ring, flushed to a file in the background.
+
+    Rows that arrive while both column sets are full are dropped and
+    counted, the loop never waits for the disk.
+    """
+
+    def __init__(self, path, stages=(), capacity=1024, interval=10.0):
+        super(Telemetry, self).__init__(name="RatNavTelemetry")
+        self.daemon = True
+
+        self.stages = tuple(stages)
+        self.dtype = telemetry_dtype(self.stages)
+        self.capacity = capacity
+        self.interval = interval
+
+        self.columns = [self.allocate(), self.allocate()]
+        self.active = 0
+        self.count = 0
+        self.flushed = None  # Stamp of the last flush
+
+        self.block = np.zeros(capacity, self.dtype)  # Interleaves the rows for writing
+        self.pending = None  # Column set being written
+        self.pending_count = 0
+
+        self.file = open(path, 'wb')
+        descr = json.dumps([(name, self.dtype[name].str) for name in self.dtype.names]).encode('ascii')
+        self.file.write(MAGIC + struct.pack('<I', len(descr)) + descr)
+
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.rows = 0
+        self.dropped = 0
+
+        self.start()
+
+    def allocate(self):
+        return dict((name, np.zeros(self.capacity, self.dtype[name])) for name in self.dtype.names)
+
+    def record(self, seq, stamp, coverage, inner, state, timer):
+        """Writes one row, taking the stage timings from the timer's latest laps"""
+
+        if self.count >= self.capacity and not self.flush():
+            self.dropped += 1
+            return
+
+        columns = self.columns[self.active]
+        row = self.count
+
+        columns['seq'][row] = seq
+        columns['stamp'][row] = stamp
+        columns['coverage'][row] = coverage
+        columns['inner'][row] = inner
+        columns['state'][row] = state
+        for stage in self.stages:
+            columns[stage][row] = timer.last(stage) * 1000.0
+
+        self.count += 1
+
+        if self.flushed is None:
+            self.flushed = stamp
+        elif stamp - self.flushed >= self.interval:
+            self.flush()
+            self.flushed = stamp
+
+    def flush(self):
+        """Hands the active rows to the writer, False if it is still busy"""
+
+        with self.condition:
+            if self.pending is not None:
+                return False
+
+            if self.count:
+                self.pending = self.active
+                self.pending_count = self.count
+                self.active = 1 - self.active
+                self.count = 0
+                self.condition.notify()
+
+        return True
+
+    def run(self):
+        block = self.block
+
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if self.pending is None:
+                    break
+                columns, count = self.columns[self.pending], self.pending_count
+
+            for name in self.dtype.names:
+                block[name][:count] = columns[name][:count]
+            block[:count].tofile(self.file)
+            self.file.flush()
+            self.rows += count
+
+            with self.condition:
+                self.pending = None
+
+        self.file.close()
+
+    def close(self):
+        """Writes the remaining rows and closes the file"""
+
+        while not self.flush():  # Wait for the writer once, at the end
+            with self.condition:
+                self.condition.wait(0.01)
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+        self.join()
+
+    def stats(self):
+        return {'rows': self.rows,
+                'dropped': self.dropped}
@@ -2,7 +2,6 @@ __author__ = 'riot'
 import cv2
 import numpy as np
 from common import anorm
-from matplotlib import pyplot as plt
 
 
 def filter_matches(kp1, kp2, matches, ratio=0.75):
@@ -85,68 +84,75 @@ def explore_match(win, img1, img2, kp_pairs, status=None, H=None):
     # return vis
 
 
-img = cv2.imread('./images/training/bmw.png', 0)
-plate = cv2.imread('./images/query/plate_german.png', 0)
+def main():
+    from matplotlib import pyplot as plt  # Only when run, it is slow to import
 
-orb = cv2.ORB()
+    img = cv2.imread('./images/training/bmw.png', 0)
+    plate = cv2.imread('./images/query/plate_german.png', 0)
 
-# global thresholding
-ret1, th1 = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY)
+    orb = cv2.ORB()
 
-# Otsu's thresholding
-ret2, th2 = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # global thresholding
+    ret1, th1 = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY)
 
-# Otsu's thresholding after Gaussian filtering
-blur = cv2.GaussianBlur(img, (3, 3), 0)
-ret3, th3 = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # Otsu's thresholding
+    ret2, th2 = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
+    # Otsu's thresholding after Gaussian filtering
+    blur = cv2.GaussianBlur(img, (3, 3), 0)
+    ret3, th3 = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
 
-# Pick these images as matching sources
-img = th2
-plate = plate
 
-# Compute keypoints
-kp_img, des_img = orb.detectAndCompute(img, None)
-kp_plate, des_plate = orb.detectAndCompute(plate, None)
+    # Pick these images as matching sources
+    img = th2
+    plate = plate
 
-img_kp_plate = cv2.drawKeypoints(plate, kp_plate, color=(0, 255, 0), flags=0)
-img_kp_img = cv2.drawKeypoints(img, kp_img, color=(255, 0, 0), flags=0)
+    # Compute keypoints
+    kp_img, des_img = orb.detectAndCompute(img, None)
+    kp_plate, des_plate = orb.detectAndCompute(plate, None)
 
-# plot all the images and their histograms
-images = [img, 0, th1,
-          img, 0, th2,
-          blur, 0, th3,
-          img_kp_plate, 0, img_kp_img]
-titles = ['Original Noisy Image', 'Histogram', 'Global Thresholding (v=127)',
-          'Original Noisy Image', 'Histogram', "Otsu's Thresholding",
-          'Gaussian filtered Image', 'Histogram', "Otsu's Thresholding",
-          'Plate KP', 'Histogram', 'Image KP']
-plt.figure(0)
-for i in xrange(4):
-    plt.subplot(5, 3, i * 3 + 1), plt.imshow(images[i * 3], 'gray')
-    plt.title(titles[i * 3]), plt.xticks([]), plt.yticks([])
-    plt.subplot(5, 3, i * 3 + 2), plt.hist(images[i * 3].ravel(), 256)
-    plt.title(titles[i * 3 + 1]), plt.xticks([]), plt.yticks([])
-    plt.subplot(5, 3, i * 3 + 3), plt.imshow(images[i * 3 + 2], 'gray')
-    plt.title(titles[i * 3 + 2]), plt.xticks([]), plt.yticks([])
+    img_kp_plate = cv2.drawKeypoints(plate, kp_plate, color=(0, 255, 0), flags=0)
+    img_kp_img = cv2.drawKeypoints(img, kp_img, color=(255, 0, 0), flags=0)
 
-plt.show()
+    # plot all the images and their histograms
+    images = [img, 0, th1,
+              img, 0, th2,
+              blur, 0, th3,
+              img_kp_plate, 0, img_kp_img]
+    titles = ['Original Noisy Image', 'Histogram', 'Global Thresholding (v=127)',
+              'Original Noisy Image', 'Histogram', "Otsu's Thresholding",
+              'Gaussian filtered Image', 'Histogram', "Otsu's Thresholding",
+              'Plate KP', 'Histogram', 'Image KP']
+    plt.figure(0)
+    for i in xrange(4):
+        plt.subplot(5, 3, i * 3 + 1), plt.imshow(images[i * 3], 'gray')
+        plt.title(titles[i * 3]), plt.xticks([]), plt.yticks([])
+        plt.subplot(5, 3, i * 3 + 2), plt.hist(images[i * 3].ravel(), 256)
+        plt.title(titles[i * 3 + 1]), plt.xticks([]), plt.yticks([])
+        plt.subplot(5, 3, i * 3 + 3), plt.imshow(images[i * 3 + 2], 'gray')
+        plt.title(titles[i * 3 + 2]), plt.xticks([]), plt.yticks([])
 
-# Do the matching
+    plt.show()
 
-bf = cv2.BFMatcher(cv2.NORM_HAMMING)  #, crossCheck=True)
+    # Do the matching
 
-print("Matching")
-matches = bf.knnMatch(des_img, trainDescriptors=des_plate, k=2)
-print("Filtering")
-p1, p2, kp_pairs = filter_matches(kp_img, kp_plate, matches)
-print("Displaying")
-img_match = explore_match('find_obj', img, plate, kp_pairs)
+    bf = cv2.BFMatcher(cv2.NORM_HAMMING)  #, crossCheck=True)
 
+    print("Matching")
+    matches = bf.knnMatch(des_img, trainDescriptors=des_plate, k=2)
+    print("Filtering")
+    p1, p2, kp_pairs = filter_matches(kp_img, kp_plate, matches)
+    print("Displaying")
+    img_match = explore_match('find_obj', img, plate, kp_pairs)
 
-# Plot the actual matching
-plt.figure(1)
-plt.imshow(img_match)
 
-plt.show()
\ No newline at end of file
+    # Plot the actual matching
+    plt.figure(1)
+    plt.imshow(img_match)
+
+    plt.show()
+
+
+if __name__ == "__main__":
+    main()
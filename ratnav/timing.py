@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+# RatNav
+# ======================================
+# Copyright (C) 2014 RatNav Contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Hot path timing
+
+Stages are timed by chaining laps, e.g.:
+> t = timer.start()
+> cv2.GaussianBlur(...)
+> t = timer.lap('smooth', t)
+> cv2.accumulateWeighted(...)
+> t = timer.lap('background', t)
+
+Each stage keeps a fixed window of recent samples plus a smoothed mean,
+report() turns them into mean, p50, p95, p99 and max in milliseconds.
+A disabled timer is a NullTimer, whose methods do nothing at all.
+
+AlertLatency follows alerts end to end: from the capture of the frame
+that triggered them, to the decision to alert, to the sound playing.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+
+from ratnav.common import clock, StatValue
+
+
+class StageStats(object):
+    """Rolling statistics of one stage"""
+
+    def __init__(self, window=256):
+        self.samples = array('d', [0.0] * window)
+        self.index = 0
+        self.count = 0
+        self.smoothed = StatValue(0.9)
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, seconds):
+        self.last = seconds
+        self.samples[self.index] = seconds
+        self.index = (self.index + 1) % len(self.samples)
+        self.count += 1
+        self.smoothed.update(seconds)
+        if seconds > self.max:
+            self.max = seconds
+
+    def summary(self):
+        """Statistics over the current window, in milliseconds"""
+
+        samples = sorted(self.samples[:min(self.count, len(self.samples))])
+        if not samples:
+            return None
+
+        def percentile(p):
+            return samples[int(round(p * (len(samples) - 1)))] * 1000.0
+
+        return OrderedDict([('count', self.count),
+                            ('mean', sum(samples) * 1000.0 / len(samples)),
+                            ('smoothed', self.smoothed.value * 1000.0),
+                            ('p50', percentile(0.5)),
+                            ('p95', percentile(0.95)),
+                            ('p99', percentile(0.99)),
+                            ('max', self.max * 1000.0)])
+
+
+class StageTimer(object):
+    """Collects per stage timings"""
+
+    enabled = True
+
+    def __init__(self, window=256):
+        self.window = window
+        self.stages = OrderedDict()
+
+    def start(self):
+        return clock()
+
+    def lap(self, stage, started):
+        """Records the time since started for the stage, returns now"""
+
+        now = clock()
+
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = StageStats(self.window)
+        stats.add(now - started)
+
+        return now
+
+    def last(self, stage):
+        """Seconds of the most recent lap of the stage"""
+
+        stats = self.stages.get(stage)
+
+        return stats.last if stats is not None else 0.0
+
+    def report(self):
+        """Statistics of all stages seen so far"""
+
+        return OrderedDict((stage, stats.summary()) for stage, stats in list(self.stages.items()))
+
+    def format(self):
+        """The report as a readable table"""
+
+        lines = ["%-12s %7s %8s %8s %8s %8s %8s" % ('stage', 'count', 'mean', 'p50', 'p95', 'p99', 'max')]
+        for stage, summary in self.report().items():
+            if summary is None:
+                continue
+            lines.append("%-12s %7i %8.3f %8.3f %8.3f %8.3f %8.3f" % (stage, summary['count'], summary['mean'],
+                                                                      summary['p50'], summary['p95'],
+                                                                      summary['p99'], summary['max']))
+        return "\n".join(lines)
+
+
+class NullTimer(object):
+    """Stand-in for a disabled StageTimer"""
+
+    enabled = False
+
+    def start(self):
+        return 0.0
+
+    def lap(self, stage, started):
+        return 0.0
+
+    def last(self, stage):
+        return 0.0
+
+    def report(self):
+        return OrderedDict()
+
+    def format(self):
+        return "Timing disabled"
+
+
+NULL_TIMER = NullTimer()
+
+
+class Histogram(object):
+    """Counts of millisecond values in fixed bins"""
+
+    def __init__(self, bounds=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bin takes everything above
+        self.total = 0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect_left(self.bounds, ms)] += 1
+        self.total += 1
+        if ms > self.max:
+            self.max = ms
+
+    def format(self):
+        labels = ["<=%g" % bound for bound in self.bounds] + [">%g" % self.bounds[-1]]
+        return " ".join("%s:%i" % (label, count) for label, count in zip(labels, self.counts) if count)
+
+
+class AlertLatency(object):
+    """Capture to decision and decision to playback latencies of emitted alerts"""
+
+    def __init__(self, keep=64):
+        self.capture_to_decision = Histogram()
+        self.decision_to_playback = Histogram()
+        # The most recent (seq, sound, frame time, c2d ms, d2p ms), all of them with keep=None
+        self.alerts = deque(maxlen=keep)
+
+    def record(self, seq, sound, captured, decided, played=None, stamp=None):
+        """
+        Records one alert, played is None when no sound was played. The
+        latencies start at the monotonic captured time, stamp is the
+        frame's own time stamp (media time in replays), if it differs.
+        """
+
+        to_decision = (decided - captured) * 1000.0
+        self.capture_to_decision.add(to_decision)
+
+        to_playback = None
+        if played is not None:
+            to_playback = (played - decided) * 1000.0
+            self.decision_to_playback.add(to_playback)
+
+        self.alerts.append((seq, sound, captured if stamp is None else stamp, to_decision, to_playback))
+
+    def format(self):
+        return "capture to decision (ms): %s\ndecision to playback (ms): %s" % (
+            self.capture_to_decision.format() or '-', self.decision_to_playback.format() or '-')